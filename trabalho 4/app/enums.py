@@ -21,6 +21,9 @@ class MarketErrorCode(Enum):
     EXPIRED_ORDER = auto()
     NOT_ENOUGH_STOCK = auto()
     UNKNOWN_TICKER = auto()
+    BUSY = auto()
+    UNKNOWN_ORDER = auto()
+    INVALID_ORDER = auto()
 
 class HomebrokerErrorCode(Enum):
     """Códigos de erro que o homebroker retorna."""
@@ -32,6 +35,9 @@ class HomebrokerErrorCode(Enum):
     UNKNOWN_TICKER = auto()
     INVALID_MESSAGE = auto()
     FORBIDDEN_NAME = auto()
+    BUSY = auto()
+    UNKNOWN_ORDER = auto()
+    INVALID_ORDER = auto()
 
     def __str__(self):
         return str(self.value)
@@ -0,0 +1,96 @@
+"""Índice dos alertas de preço de uma ação."""
+import heapq
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+
+Limits = Tuple[Optional[float], Optional[float]]
+
+# Tamanho mínimo dos heaps para tirar deles os limites removidos
+COMPACT_MIN_SIZE = 1024
+
+
+class AlertIndex:
+    """
+    Alertas de preço dos clientes para uma ação.
+
+    Guarda os limites mínimos em um heap que tem o maior mínimo no topo
+    e os limites máximos em um heap que tem o menor máximo no topo,
+    então uma cotação nova só tira dos heaps os alertas que ela cruzou,
+    em vez de passar por todos os alertas da ação.
+    Colocar um alerta custa O(log n) e tirar custa O(1): o limite antigo continua no heap,
+    marcado pela versão do alerta, e só sai quando chega no topo ou quando o heap é compactado.
+    """
+    def __init__(self):
+        # {cliente: (limite mínimo, limite máximo)}
+        self.limits: Dict[str, Limits] = {}
+        # Versão do alerta atual de cada cliente, para reconhecer os limites removidos nos heaps
+        self.versions: Dict[str, int] = {}
+        self.next_version = 0
+        # (-limite mínimo, versão, cliente)
+        self.lower_heap: List[Tuple[float, int, str]] = []
+        # (limite máximo, versão, cliente)
+        self.upper_heap: List[Tuple[float, int, str]] = []
+
+    @classmethod
+    def from_limits(cls, limits: Mapping[str, Sequence[Optional[float]]]) -> 'AlertIndex':
+        """Cria o índice a partir de {cliente: (limite mínimo, limite máximo)}."""
+        index = cls()
+        for client, (lower, upper) in limits.items():
+            index.set(client, lower, upper)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.limits)
+
+    def __contains__(self, client: str) -> bool:
+        return client in self.limits
+
+    def __getitem__(self, client: str) -> Limits:
+        return self.limits[client]
+
+    def set(self, client: str, lower: Optional[float], upper: Optional[float]):
+        """Coloca ou substitui o alerta de um cliente. Limites None não alertam."""
+        version = self.next_version
+        self.next_version += 1
+        self.limits[client] = (lower, upper)
+        self.versions[client] = version
+        if lower is not None:
+            heapq.heappush(self.lower_heap, (-lower, version, client))
+        if upper is not None:
+            heapq.heappush(self.upper_heap, (upper, version, client))
+        self.compact()
+
+    def remove(self, client: str):
+        """Remove o alerta de um cliente. Dá KeyError se o cliente não tem alerta."""
+        del self.limits[client]
+        del self.versions[client]
+        self.compact()
+
+    def pop_crossed(self, price: float) -> List[str]:
+        """
+        Remove e retorna os clientes cujo alerta foi cruzado por uma cotação,
+        ou seja, o preço ficou menor ou igual ao mínimo ou maior ou igual ao máximo.
+        """
+        crossed: List[str] = []
+        while self.lower_heap and -self.lower_heap[0][0] >= price:
+            self.pop_if_current(self.lower_heap, crossed)
+        while self.upper_heap and self.upper_heap[0][0] <= price:
+            self.pop_if_current(self.upper_heap, crossed)
+        if crossed:
+            self.compact()
+        return crossed
+
+    def pop_if_current(self, heap: List[Tuple[float, int, str]], crossed: List[str]):
+        """Tira o topo de um heap. Se é o limite do alerta atual do cliente, remove o alerta e guarda o cliente."""
+        _, version, client = heapq.heappop(heap)
+        if self.versions.get(client) == version:
+            del self.limits[client]
+            del self.versions[client]
+            crossed.append(client)
+
+    def compact(self):
+        """Quando a maior parte dos heaps é de limites removidos, reconstrói os heaps sem eles."""
+        if len(self.lower_heap) + len(self.upper_heap) <= max(COMPACT_MIN_SIZE, 4 * len(self.limits)):
+            return
+        for heap in (self.lower_heap, self.upper_heap):
+            heap[:] = [entry for entry in heap if self.versions.get(entry[2]) == entry[1]]
+            heapq.heapify(heap)
@@ -13,13 +13,17 @@ from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 
 import flask
 import Pyro5.api as pyro
-from Pyro5.errors import excepthook as pyro_excepthook
+from Pyro5.errors import CommunicationError, NamingError, excepthook as pyro_excepthook
 
+from .alert_index import AlertIndex
 from .client import Client, ClientStatus
 from .consts import DATETIME_FORMAT
 from .enums import HomebrokerErrorCode, MarketErrorCode, OrderType
 from .order import Order, Transaction
 
+# Períodos de atualização sem receber cotações do StockMarket até buscar e se inscrever de novo
+QUOTE_PUSH_TIMEOUT_PERIODS = 3
+
 
 class Homebroker:
     """
@@ -32,6 +36,8 @@ class Homebroker:
 
     Periodicamente pega atualizações de StockMarket,
     avisando os clientes caso tenha ocorrido algum evento de interesse.
+    As cotações não são buscadas, o StockMarket envia as que mudaram para `push_quotes`.
+    Se o StockMarket fica um tempo sem enviar, busca as cotações e renova a inscrição.
     """
 
     def __init__(self, name: str, update_period: float):
@@ -62,18 +68,22 @@ class Homebroker:
         self.quotes: Dict[str, Optional[float]] = {}
         self.quotes_lock = threading.Lock()
 
-        self.alert_limits: Dict[str, Dict[str, Tuple[float, float]]] = {}
+        # Alertas de preço de cada ação
+        self.alert_limits: Dict[str, AlertIndex] = {}
         self.alerts_lock = threading.Lock()
 
         self.last_updated = datetime.datetime.now()
+        # Momento em que recebeu cotações do StockMarket pela última vez, pelo relógio monotônico.
+        # Criado antes da thread de atualizações, que usa ele para renovar a inscrição
+        self.last_push = time.monotonic()
 
         # Carrega as informações internas do homebroker
         self.load_initial_state()
 
         # Registra o objeto no daemon do Pyro e no nameserver
         self.daemon = pyro.Daemon()
-        my_uri = self.daemon.register(self)
-        nameserver.register(f'homebroker-{self.name}', my_uri)
+        self.uri = self.daemon.register(self)
+        nameserver.register(f'homebroker-{self.name}', self.uri)
 
         # Registra o sinal pra fechar direito o programa
         signal.signal(signal.SIGINT, self.close)
@@ -86,6 +96,12 @@ class Homebroker:
         self.thread_request_loop = threading.Thread(target=self.run, daemon=True)
         self.thread_request_loop.start()
 
+        # Se inscreve nas cotações das ações observadas
+        with self.quotes_lock:
+            tickers = list(self.quotes.keys())
+        with self.get_market():
+            self.market.subscribe_quotes(tickers, str(self.uri))
+
     def load_initial_state(self):
         self.instance_path = Path(f'./instances/{self.name}')
         clients_path = self.instance_path / 'clients'
@@ -115,7 +131,9 @@ class Homebroker:
                 data = json.load(fp)
             #TODO: Verificar por que está sobrescrevendo os alertas
             self.quotes = data['quotes']
-            self.alert_limits = data['alert_limits']
+            self.alert_limits = {
+                ticker: AlertIndex.from_limits(limits)
+                for ticker, limits in data['alert_limits'].items()}
             self.last_updated = datetime.datetime.strptime(data['last_updated'], DATETIME_FORMAT)
 
     def write_internal_data_file(self):
@@ -124,7 +142,8 @@ class Homebroker:
                 with open(self.instance_path/'internal_data.json', 'w') as fp:
                     json.dump({
                         'quotes': self.quotes,
-                        'alert_limits': self.alert_limits,
+                        'alert_limits': {
+                            ticker: index.limits for ticker, index in self.alert_limits.items()},
                         'last_updated': self.last_updated.strftime(DATETIME_FORMAT)
                     }, fp)
 
@@ -149,6 +168,9 @@ class Homebroker:
         """
         print("Fechando o homebroker")
         try:
+            # Para de receber as cotações
+            with self.get_market():
+                self.market.unsubscribe_quotes(None, str(self.uri))
             # Fecha a conexão com os clientes
             # with self.clients_lock:
                 for client in self.clients.values():
@@ -183,51 +205,110 @@ class Homebroker:
         Envia notificações para os clientes caso ocorra algum evento.
 
         locks:
-            update_quotes()
             update_orders()
         """
         while(True):
             time.sleep(self.update_period)
-            self.update_quotes()
+            self.renew_quote_subscription()
             self.update_orders()
 
-    def update_quotes(self):
+    def renew_quote_subscription(self):
+        """
+        Se o StockMarket não envia cotações há alguns períodos, busca as cotações e se inscreve de novo.
+        O StockMarket esquece a inscrição quando reinicia ou quando não consegue enviar as cotações,
+        e se inscrever de novo não muda nada se a inscrição ainda existe.
+        Em um mercado parado também não chegam cotações, então a busca funciona como polling.
+
+        locks:
+            quotes_lock
+            market_lock
+            update_quotes()
+        """
+        if time.monotonic() - self.last_push < QUOTE_PUSH_TIMEOUT_PERIODS * self.update_period:
+            return
+        self.last_push = time.monotonic()
+        with self.quotes_lock:
+            tickers = list(self.quotes.keys())
+        if not tickers:
+            return
+        try:
+            with self.get_market():
+                quotes = self.market.get_quotes(tickers)
+                self.market.subscribe_quotes(tickers, str(self.uri))
+        except CommunicationError:
+            print("Não foi possível renovar a inscrição nas cotações, procurando o mercado de novo")
+            self.reconnect_market()
+            return
+        self.update_quotes(quotes)
+
+    def reconnect_market(self):
+        """
+        Pega de novo o endereço do StockMarket no nameserver, que muda quando o mercado reinicia.
+
+        locks:
+            market_lock
         """
-        Atualiza as cotações de todas as ações que o homebroker observa.
+        try:
+            market_uri = pyro.locate_ns().lookup('stockmarket')
+        except (CommunicationError, NamingError):
+            return
+        with self.get_market():
+            self.market._pyroRelease()
+            self.market = pyro.Proxy(market_uri)
+
+    @pyro.expose
+    @pyro.oneway
+    def push_quotes(self, quotes: Dict[str, Optional[float]]):
+        """
+        Recebe do StockMarket as cotações que mudaram.
+
+        locks:
+            update_quotes()
+        """
+        self.last_push = time.monotonic()
+        self.update_quotes(quotes)
+
+    def watch_ticker(self, ticker: str):
+        """
+        Começa a observar a cotação de uma ação, se ainda não observava.
+
+        locks:
+            quotes_lock
+            market_lock
+            update_quotes()
+        """
+        with self.quotes_lock:
+            if ticker in self.quotes:
+                return
+        # Pega o valor atual e se inscreve para receber as mudanças
+        with self.get_market():
+            value = self.market.get_quotes([ticker])[ticker]
+            self.market.subscribe_quotes([ticker], str(self.uri))
+        self.update_quotes({ticker: value})
+
+    def update_quotes(self, new_quotes: Dict[str, Optional[float]]):
+        """
+        Atualiza as cotações das ações que o homebroker observa.
         
         locks:
             quotes_lock
-                market_lock
-                alerts_lock
+            alerts_lock
         """
         # Atualiza as cotações
         with self.quotes_lock:
-            with self.get_market():
-                self.quotes = self.market.get_quotes(self.quotes.keys())
-            # Pega uma cópia porque essa funcao pode ser chamada de varios lugares ao mesmo tempo
-            quotes_copy = self.quotes.copy()
-        quotes_copy = {ticker: value for ticker, value in quotes_copy.items() if value is not None}
-        # Envia os alertas de limite de preço para os clientes, caso haja
-        alerts_to_remove = []
-        for ticker in quotes_copy:
-            # Se tem alerta para a ação
-            if ticker in self.alert_limits:
-                with self.alerts_lock:
-                    for client, limits in self.alert_limits[ticker].items():
-                        # Se tem limite minimo e o valor da ação ta mais baixo que o limite
-                        # Ou se tem maximo e o valor da ação ta maior
-                        if ((limits[0] is not None) and (quotes_copy[ticker] <= limits[0])
-                                or ((limits[1] is not None) and (quotes_copy[ticker] >= limits[1]))):
-                            # Chama a callback do cliente
-                            self.clients[client].notify_limit(ticker, quotes_copy[ticker])
-                            alerts_to_remove.append((ticker, client))
+            self.quotes.update(new_quotes)
+        quotes_copy = {ticker: value for ticker, value in new_quotes.items() if value is not None}
+        # Tira os alertas que a cotação cruzou (o valor ficou abaixo do mínimo ou acima do máximo)
+        crossed_alerts: List[Tuple[str, str]] = []
         with self.alerts_lock:
-            for ticker_client in alerts_to_remove:
-                try:
-                    self.alert_limits[ticker_client[0]].pop(ticker_client[1])
-                # Se foi removida por outra thread, não faz mal
-                except KeyError:
-                    pass
+            for ticker in quotes_copy:
+                if ticker in self.alert_limits:
+                    crossed_alerts.extend(
+                        (ticker, client)
+                        for client in self.alert_limits[ticker].pop_crossed(quotes_copy[ticker]))
+        # Envia os alertas para os clientes, sem segurar a trava
+        for ticker, client in crossed_alerts:
+            self.clients[client].notify_limit(ticker, quotes_copy[ticker])
 
         # Salva as atualizações em um arquivo
         self.write_internal_data_file()
@@ -297,11 +378,7 @@ class Homebroker:
                         for ticker in self.clients[client_name].owned_stock.get():
                             with self.clients[client_name].quotes as quotes:
                                 if ticker not in quotes:
-                                    with self.quotes_lock:
-                                        with self.get_market():
-                                            price = self.market.get_quotes([ticker])
-                                            if (price is not None):
-                                                self.quotes[ticker] = price
+                                    self.watch_ticker(ticker)
                                     quotes.append(ticker)
 
                     notifications_per_client[client_name][3] = self.clients[client_name].owned_stock.get()
@@ -349,8 +426,7 @@ class Homebroker:
         
         locks:
             market_lock
-            quotes_lock
-            update_quotes()
+            watch_ticker()
         """
         print("add_stock_to_quotes->(", ticker, ", ",client_name, ")")
 
@@ -367,12 +443,7 @@ class Homebroker:
             if ticker not in quotes:
                 quotes.append(ticker)
 
-        # Pega o valor da ação (atualiza todo mundo)
-        with self.get_market():
-            value = self.market.get_quotes([ticker])
-        with self.quotes_lock:
-                self.quotes[ticker] = value
-        self.update_quotes()
+        self.watch_ticker(ticker)
 
         return str(HomebrokerErrorCode.SUCCESS), 200
 
@@ -383,6 +454,7 @@ class Homebroker:
         locks:
             clients_lock
             quotes_lock
+            market_lock
         """
         print("remove_stock_from_quotes", ticker, client_name)
 
@@ -408,6 +480,8 @@ class Homebroker:
         if not has_interest:
             with self.quotes_lock:
                 self.quotes.pop(ticker)
+            with self.get_market():
+                self.market.unsubscribe_quotes([ticker], str(self.uri))
         
         return str(HomebrokerErrorCode.SUCCESS), 200
 
@@ -416,7 +490,6 @@ class Homebroker:
         Retorna as cotações atuais das ações que o cliente está interessado.
 
         locks:
-            update_quotes()
             quotes_lock
         """
         print("get_current_quotes", client_name)
@@ -424,8 +497,6 @@ class Homebroker:
         if client_name not in self.clients:
             return str(HomebrokerErrorCode.UNKNOWN_CLIENT), 404
 
-        self.update_quotes()
-
         # Pega todas as cotações desse cliente
         with self.quotes_lock:
             client_quotes : Dict[str, Optional[float]] = {
@@ -462,9 +533,8 @@ class Homebroker:
         # Adiciona o limite
         with self.alerts_lock:
             if ticker not in self.alert_limits:
-                self.alert_limits[ticker] = {client_name: (lower_limit, upper_limit)}
-            else:
-                self.alert_limits[ticker][client_name] = (lower_limit, upper_limit)
+                self.alert_limits[ticker] = AlertIndex()
+            self.alert_limits[ticker].set(client_name, lower_limit, upper_limit)
 
         return str(HomebrokerErrorCode.SUCCESS), 200
 
@@ -484,23 +554,114 @@ class Homebroker:
         error = MarketErrorCode(error)
         # Se deu erro, retorna e avisa o cliente
         if error is not MarketErrorCode.SUCCESS:
-            error = HomebrokerErrorCode[error.name]
-            if error in (HomebrokerErrorCode.EXPIRED_ORDER,):
-                status = 400
-            elif error in (HomebrokerErrorCode.UNKNOWN_CLIENT,
-                            HomebrokerErrorCode.UNKNOWN_TICKER):
-                status = 404
-            elif error in (HomebrokerErrorCode.NOT_ENOUGH_STOCK,):
-                status = 403
-            # Se não é nenhum dos erros esperados, alguma coisa está errada com o servidor
-            else:
-                status = 500
-            return str(error), status
+            return self.market_error_response(error)
 
         self.clients[order.client_name].orders.get().append(order)
 
         return str(HomebrokerErrorCode.SUCCESS), 200
 
+    @staticmethod
+    def market_error_response(error: MarketErrorCode) -> flask.Response:
+        """Retorna a resposta para o cliente de um erro do mercado."""
+        error = HomebrokerErrorCode[error.name]
+        if error in (HomebrokerErrorCode.EXPIRED_ORDER,
+                     HomebrokerErrorCode.INVALID_ORDER):
+            status = 400
+        elif error in (HomebrokerErrorCode.UNKNOWN_CLIENT,
+                        HomebrokerErrorCode.UNKNOWN_TICKER,
+                        HomebrokerErrorCode.UNKNOWN_ORDER):
+            status = 404
+        elif error in (HomebrokerErrorCode.NOT_ENOUGH_STOCK,):
+            status = 403
+        elif error in (HomebrokerErrorCode.BUSY,):
+            status = 503
+        # Se não é nenhum dos erros esperados, alguma coisa está errada com o servidor
+        else:
+            status = 500
+        return str(error), status
+
+    def cancel_order(self, client_name: str, order_type: OrderType, order_id: int) -> flask.Response:
+        """
+        Cancela uma ordem ativa de um cliente.
+
+        locks:
+            market_lock
+            orders_lock
+        """
+        print('Cancel order', client_name, order_type, order_id)
+
+        if client_name not in self.clients:
+            return str(HomebrokerErrorCode.UNKNOWN_CLIENT), 404
+
+        with self.get_market():
+            error = self.market.cancel_order(client_name, order_type.value, order_id)
+        error = MarketErrorCode(error)
+        if error is not MarketErrorCode.SUCCESS:
+            return self.market_error_response(error)
+
+        # Tira a ordem da lista do cliente
+        with self.clients[client_name].orders as orders:
+            orders[:] = [
+                order for order in orders
+                if not (order.id == order_id and order.type is order_type)]
+
+        return str(HomebrokerErrorCode.SUCCESS), 200
+
+    def amend_order(self,
+                    client_name: str,
+                    order_type: OrderType,
+                    order_id: int,
+                    amount: float,
+                    price: float) -> flask.Response:
+        """
+        Altera a quantidade e o preço de uma ordem ativa de um cliente.
+
+        locks:
+            market_lock
+            orders_lock
+        """
+        print('Amend order', client_name, order_type, order_id, amount, price)
+
+        if client_name not in self.clients:
+            return str(HomebrokerErrorCode.UNKNOWN_CLIENT), 404
+
+        with self.get_market():
+            error = self.market.amend_order(client_name, order_type.value, order_id, amount, price)
+        error = MarketErrorCode(error)
+        if error is not MarketErrorCode.SUCCESS:
+            return self.market_error_response(error)
+
+        # Atualiza a ordem na lista do cliente
+        with self.clients[client_name].orders as orders:
+            for order in orders:
+                if order.id == order_id and order.type is order_type:
+                    order.amount = amount
+                    order.price = price
+
+        return str(HomebrokerErrorCode.SUCCESS), 200
+
+    def create_orders(self, orders: Sequence[Order]) -> flask.Response:
+        """
+        Cria um conjunto de ordens de compra ou de venda com uma chamada só para a bolsa.
+        Retorna o código de erro de cada ordem, na mesma ordem em que foram dadas.
+
+        locks:
+            market_lock
+        """
+        print('Create orders', len(orders))
+
+        with self.get_market():
+            # Manda todas pra bolsa de uma vez
+            errors = self.market.create_orders(orders)
+        errors = [HomebrokerErrorCode[MarketErrorCode(error).name] for error in errors]
+
+        # Guarda as ordens que foram criadas
+        for order, error in zip(orders, errors):
+            if error is HomebrokerErrorCode.SUCCESS and order.client_name in self.clients:
+                self.clients[order.client_name].orders.get().append(order)
+
+        return flask.jsonify([str(error) for error in errors])
+
     def connect_client(self, client_name) -> flask.Response:
         """
         Conecta um cliente novo ao homebroker.
@@ -701,6 +862,60 @@ def create_order() -> flask.Response:
     return homebroker.create_order(order)
 
 
+@flask_app.route('/order', methods=['DELETE'])
+def cancel_order() -> flask.Response:
+    global homebroker
+    # Pega os argumentos do request
+    try:
+        client_name = flask.request.args['client_name']
+        order_type = OrderType(flask.request.args['type'])
+        order_id = int(flask.request.args['id'])
+    # Se não tinha um dos argumentos ou argumento invalido
+    except (KeyError, ValueError):
+        return str(HomebrokerErrorCode.INVALID_MESSAGE), 400
+
+    return homebroker.cancel_order(client_name, order_type, order_id)
+
+
+@flask_app.route('/order', methods=['PUT'])
+def amend_order() -> flask.Response:
+    global homebroker
+    # Pega os argumentos do request
+    request_body = flask.request.get_json()
+    # Se o tipo não era text/json é None
+    if request_body is None:
+        return str(HomebrokerErrorCode.INVALID_MESSAGE), 400
+    try:
+        client_name = request_body['client_name']
+        order_type = OrderType(request_body['type'])
+        order_id = int(request_body['id'])
+        amount = float(request_body['amount'])
+        price = float(request_body['price'])
+    # Se não tinha um dos argumentos ou argumento invalido
+    except (KeyError, ValueError, TypeError):
+        return str(HomebrokerErrorCode.INVALID_MESSAGE), 400
+
+    return homebroker.amend_order(client_name, order_type, order_id, amount, price)
+
+
+@flask_app.route('/orders', methods=['POST'])
+def create_orders() -> flask.Response:
+    global homebroker
+    # Pega a lista de ordens do request
+    request_body = flask.request.get_json()
+    # Se o tipo não era text/json é None
+    if not isinstance(request_body, list):
+        return str(HomebrokerErrorCode.INVALID_MESSAGE), 400
+    try:
+        orders = [Order.from_dict('Order', order_dict) for order_dict in request_body]
+
+    # Se não tinha um dos argumentos ou argumento invalido
+    except KeyError:
+        return str(HomebrokerErrorCode.INVALID_MESSAGE), 400
+
+    return homebroker.create_orders(orders)
+
+
 @flask_app.route('/login', methods=['GET'])
 def connect_client() -> flask.Response:
     global homebroker
@@ -15,6 +15,8 @@ class Order:
     :param amount: Quantidade de ações que deseja transacionar.
     :param price: Preço máximo de compra ou preço mínimo de venda.
     :param expiry_date: Data em que a ordem expira.
+    :param active: Se a ordem está ativa. Se None, é ativa se não expirou.
+    :param id_: Id da ordem no banco de dados, ou None se a ordem ainda não foi criada.
     """
     def __init__(self,
                  client_name: str,
@@ -24,6 +26,7 @@ class Order:
                  price: float,
                  expiry_date: Union[datetime.datetime, str],
                  active: Optional[bool] = None,
+                 id_: Optional[int] = None,
                  **kwargs):
         self.client_name = client_name
         self.type = type_
@@ -37,6 +40,7 @@ class Order:
             active if active is not None
             else not self.is_expired()
         )
+        self.id = id_
 
     def is_expired(self):
         """Retorna se a ordem expirou ou não."""
@@ -53,7 +57,8 @@ class Order:
             'amount': order.amount,
             'price': order.price,
             'expiry_date': order.expiry_date.strftime(DATETIME_FORMAT),
-            'active': order.active
+            'active': order.active,
+            'id': order.id
         }
 
     @staticmethod
@@ -66,7 +71,8 @@ class Order:
             dict_['amount'],
             dict_['price'],
             datetime.datetime.strptime(dict_['expiry_date'], DATETIME_FORMAT),
-            dict_['active']
+            dict_['active'],
+            dict_.get('id')
         )
 
     def __repr__(self):
@@ -78,7 +84,8 @@ class Order:
             f"amount={self.amount}, "
             f"price={self.price}, "
             f"expiry_date={self.expiry_date}, "
-            f"active={self.active}"
+            f"active={self.active}, "
+            f"id_={self.id}"
             ")"
         )
 
@@ -0,0 +1,54 @@
+"""Mapa em memória entre o nome e o id dos clientes."""
+import threading
+from typing import Dict, Iterable, List, Mapping, Optional
+
+from . import queries
+from .database import Database
+
+
+class ClientDirectory:
+    """
+    Nome e id no DB de todos os clientes, para não consultar a tabela Client a cada ordem.
+    Clientes nunca são removidos nem renomeados, então o mapa só precisa ser
+    carregado ao iniciar e atualizado quando um cliente é criado.
+
+    :param db: Banco de dados do mercado.
+    """
+    def __init__(self, db: Database):
+        self.db = db
+        self.ids_by_name: Dict[str, int] = {}
+        self.names_by_id: Dict[int, str] = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Carrega todos os clientes do DB."""
+        data = self.db.run_query(queries.SELECT_CLIENTS)
+        with self.lock:
+            for client_id, name in data:
+                self.ids_by_name[name] = client_id
+                self.names_by_id[client_id] = name
+
+    def add(self, name: str) -> int:
+        """Insere um cliente novo no DB e no mapa. Retorna o id dele."""
+        client_id = self.db.run_query(queries.INSERT_CLIENT, name=name)
+        with self.lock:
+            self.ids_by_name[name] = client_id
+            self.names_by_id[client_id] = name
+        return client_id
+
+    def get_names(self) -> List[str]:
+        """Retorna o nome de todos os clientes."""
+        with self.lock:
+            return list(self.ids_by_name)
+
+    def get_id(self, name: str) -> Optional[int]:
+        """Retorna o id de um cliente, ou None se ele não existe."""
+        return self.ids_by_name.get(name)
+
+    def get_name(self, client_id: int) -> Optional[str]:
+        """Retorna o nome de um cliente, ou None se ele não existe."""
+        return self.names_by_id.get(client_id)
+
+    def get_ids(self, names: Iterable[str]) -> Mapping[str, Optional[int]]:
+        """Retorna o id de cada nome. Nomes que não existem têm valor None."""
+        return {name: self.ids_by_name.get(name) for name in names}
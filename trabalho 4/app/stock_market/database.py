@@ -1,47 +1,294 @@
+import queue
 import sqlite3
 import threading
-from typing import Dict
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, Iterable, List, Mapping, Optional
 
+from . import queries
+from .migrations import MIGRATIONS, Migration
+from .queries import Fetch, Query
+from .timestamps import from_epoch_ms
 from ..order import Order, OrderType
 
+# Tamanho do cache de páginas de cada conexão, em KiB (valor negativo pro sqlite)
+POOLED_CACHE_SIZE_KIB = 16 * 1024
+# Quantidade de consultas compiladas guardadas por conexão
+STATEMENT_CACHE_SIZE = 256
+# Tempo máximo em milissegundos que uma conexão espera o DB destravar
+POOLED_BUSY_TIMEOUT_MS = 5000
+
+
 class Database:
-    """Wrapper para o banco de dados do stock market."""
-    def __init__(self, db_path: str):
-        self.db = sqlite3.connect(db_path, check_same_thread=False)
-        self.db_cursor = self.db.cursor()
+    """
+    Wrapper para o banco de dados do stock market.
+
+    :param db_path: Caminho do banco de dados.
+    :param pooled: Se False, todas as threads usam a mesma conexão, uma operação de cada vez.
+        Se True, cada thread tem a sua conexão, com o DB em modo WAL,
+        então as leituras rodam ao mesmo tempo entre si e com a escrita.
+        As escritas continuam sendo uma de cada vez.
+        Sem group commit, os commits não sincronizam o disco (`synchronous = normal`),
+        então os últimos commits podem se perder se o computador desligar.
+    :param group_commit_window: Se não for None, as escritas são feitas por uma thread própria,
+        que junta as escritas que chegam durante essa janela (em segundos)
+        e faz um commit só para todas elas. Quem escreveu espera o commit terminar,
+        e o commit só termina depois de estar gravado no disco.
+        Se for None, cada escrita faz o seu commit.
+    :param group_commit_size: Quantidade máxima de escritas juntadas em um commit.
+    """
+    def __init__(self,
+                 db_path: str,
+                 pooled: bool = False,
+                 group_commit_window: Optional[float] = None,
+                 group_commit_size: int = 64):
+        self.db_path = db_path
+        self.pooled = pooled
+        self.group_commit_window = group_commit_window
+        self.group_commit_size = group_commit_size
+        # No modo pooled só serializa as escritas
         self.db_lock = threading.Lock()
+        if pooled:
+            self.local = threading.local()
+            self.connections: List[sqlite3.Connection] = []
+            self.connections_lock = threading.Lock()
+            # O modo WAL fica salvo no arquivo, então só precisa configurar uma vez
+            self.get_connection().execute('pragma journal_mode = wal')
+        else:
+            self.db = sqlite3.connect(
+                db_path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+            self.db_cursor = self.db.cursor()
+
+        # Estatísticas das escritas
+        self.commits = 0
+        self.statements = 0
 
-    def execute(self, command: str, *args, **kwargs) -> int:
-        """Executa uma operação no DB."""
+        if group_commit_window is not None:
+            # Escritas esperando o próximo commit: (comando, parâmetros, se é executemany, Future)
+            self.writes: queue.Queue = queue.Queue()
+            self.writer = threading.Thread(target=self.run_writer, daemon=True)
+            self.writer.start()
+
+    def get_connection(self) -> sqlite3.Connection:
+        """Retorna a conexão da thread atual, criando se ainda não tem."""
+        if not self.pooled:
+            return self.db
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.db_path, check_same_thread=False, timeout=POOLED_BUSY_TIMEOUT_MS / 1000,
+                cached_statements=STATEMENT_CACHE_SIZE)
+            # Com WAL, synchronous normal só sincroniza o disco nos checkpoints, então um commit
+            # pode se perder se o computador desligar. A thread de escrita do group commit
+            # avisa os escritores só depois do commit, então ela sincroniza o disco em todo commit
+            if threading.current_thread() is getattr(self, 'writer', None):
+                connection.execute('pragma synchronous = full')
+            else:
+                connection.execute('pragma synchronous = normal')
+            connection.execute(f'pragma cache_size = -{POOLED_CACHE_SIZE_KIB}')
+            self.local.connection = connection
+            with self.connections_lock:
+                self.connections.append(connection)
+        return connection
+
+    def get_cursor(self) -> sqlite3.Cursor:
+        """Retorna o cursor que a thread atual deve usar."""
+        if not self.pooled:
+            return self.db_cursor
+        return self.get_connection().cursor()
+
+    def execute(self, command: str, params: Any = ()) -> int:
+        """Executa uma escrita no DB. Retorna depois do commit, com o id da última linha inserida."""
+        if self.group_commit_window is not None:
+            return self.submit_write(command, params, False)
         with self.db_lock:
-            cursor =  self.db_cursor.execute(command, *args, **kwargs)
-            self.db.commit()
+            cursor =  self.get_cursor().execute(command, params)
+            cursor.connection.commit()
+            self.commits += 1
+            self.statements += 1
             return cursor.lastrowid
 
+    def execute_many(self, command: str, rows) -> None:
+        """Executa uma escrita no DB para cada conjunto de argumentos, com um commit só."""
+        if self.group_commit_window is not None:
+            self.submit_write(command, list(rows), True)
+            return
+        with self.db_lock:
+            cursor = self.get_cursor()
+            cursor.executemany(command, rows)
+            cursor.connection.commit()
+            self.commits += 1
+            self.statements += 1
+
+    def submit_write(self, command: str, params: Any, many: bool) -> Optional[int]:
+        """Coloca uma escrita na fila da thread de escrita e espera o commit dela."""
+        future = Future()
+        self.writes.put((command, params, many, future))
+        return future.result()
+
+    def run_writer(self):
+        """Thread de escrita. Junta as escritas que chegam durante a janela e faz um commit só."""
+        while True:
+            write = self.writes.get()
+            if write is None:
+                return
+            batch = [write]
+            deadline = time.monotonic() + self.group_commit_window
+            while len(batch) < self.group_commit_size:
+                try:
+                    write = self.writes.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                # Pedido pra fechar, escreve o que já tem e termina
+                if write is None:
+                    self.write_batch(batch)
+                    return
+                batch.append(write)
+            self.write_batch(batch)
+
+    def write_batch(self, batch: List[tuple]):
+        """Executa um conjunto de escritas e faz um commit só. Avisa cada escritor do resultado."""
+        results = []
+        with self.db_lock:
+            cursor = self.get_cursor()
+            for command, params, many, future in batch:
+                # Se um comando falha, o sqlite desfaz só ele, os outros continuam
+                try:
+                    if many:
+                        cursor.executemany(command, params)
+                        results.append((future, None, None))
+                    else:
+                        cursor.execute(command, params)
+                        results.append((future, cursor.lastrowid, None))
+                except Exception as e:
+                    results.append((future, None, e))
+            try:
+                cursor.connection.commit()
+            except Exception as e:
+                cursor.connection.rollback()
+                results = [(future, None, e) for future, _, _ in results]
+            else:
+                self.commits += 1
+                self.statements += len(batch)
+
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def get_write_stats(self) -> Dict[str, float]:
+        """Retorna a quantidade de commits e de escritas, e a média de escritas por commit."""
+        with self.db_lock:
+            return {
+                'commits': self.commits,
+                'statements': self.statements,
+                'statements_per_commit': self.statements / self.commits if self.commits else 0.0
+            }
+
+    def run_query(self, query: Query, **params: Any) -> Any:
+        """
+        Executa uma consulta de `queries` com parâmetros nomeados.
+        Escritas retornam o id da última linha inserida, leituras retornam uma linha ou todas.
+        """
+        if query.fetch is Fetch.NONE:
+            return self.execute(query.sql, params)
+        return self.execute_with_fetch(query.sql, query.fetch is Fetch.ALL, params)
+
+    def run_query_many(self, query: Query, rows: Iterable[Mapping[str, Any]]):
+        """Executa uma escrita de `queries` para cada conjunto de parâmetros, com um commit só."""
+        if query.fetch is not Fetch.NONE:
+            raise ValueError(f"'{query.name}' is not a write query.")
+        self.execute_many(query.sql, rows)
+
+    def migrate(self, migrations: Iterable[Migration] = MIGRATIONS) -> int:
+        """
+        Aplica as migrações que o DB ainda não tem, cada uma na sua transação.
+        Retorna a versão do esquema depois das migrações.
+        """
+        with self.db_lock:
+            connection = self.get_connection()
+            version = connection.execute('pragma user_version').fetchone()[0]
+            # O sqlite3 faz commit antes de cada comando DDL no modo padrão,
+            # então as transações das migrações são abertas e fechadas explicitamente
+            isolation_level = connection.isolation_level
+            connection.isolation_level = None
+            try:
+                for migration in sorted(migrations, key=lambda migration: migration.version):
+                    if migration.version <= version:
+                        continue
+                    connection.execute('begin')
+                    try:
+                        migration.apply(connection)
+                        # O pragma não aceita parâmetros, mas a versão é sempre um inteiro
+                        connection.execute(f'pragma user_version = {int(migration.version)}')
+                        connection.execute('commit')
+                    except Exception:
+                        connection.execute('rollback')
+                        raise
+                    version = migration.version
+                    print(f"Applied migration {version}: {migration.description}")
+            finally:
+                connection.isolation_level = isolation_level
+        return version
+
+    def check_query_plans(self,
+                          hot_queries: Iterable[Query] = queries.HOT_QUERIES,
+                          primary_key_queries: Iterable[Query] = queries.PRIMARY_KEY_QUERIES) -> List[str]:
+        """
+        Retorna as consultas que deveriam usar índice mas leem a tabela inteira,
+        e as que deveriam buscar pelo id mas usam outro índice,
+        no formato '<nome da consulta>: <passo do plano>'.
+        """
+        regressions = []
+        for query in hot_queries:
+            for detail in self.get_query_plan(query):
+                # 'SCAN <tabela>' sem índice é leitura da tabela inteira
+                if detail.startswith('SCAN ') and ' USING ' not in detail:
+                    regressions.append(f'{query.name}: {detail}')
+        for query in primary_key_queries:
+            for detail in self.get_query_plan(query):
+                if detail.startswith(('SCAN ', 'SEARCH ')) and 'PRIMARY KEY' not in detail:
+                    regressions.append(f'{query.name}: {detail}')
+        return regressions
+
+    def get_query_plan(self, query: Query) -> List[str]:
+        """Retorna os passos do plano de uma consulta que leem tabelas, ignorando as listas de `json_each`."""
+        # Só o plano importa, então os parâmetros podem ter qualquer valor
+        params = {name: '[]' for name in queries.get_parameter_names(query)}
+        plan = self.execute_with_fetch(f'explain query plan {query.sql}', True, params)
+        return [detail for _, _, _, detail in plan if 'json_each' not in detail]
+
     def close(self):
-        self.db.close()
+        # Espera as escritas que estão na fila
+        if self.group_commit_window is not None:
+            self.writes.put(None)
+            self.writer.join()
+        if not self.pooled:
+            self.db.close()
+            return
+        with self.connections_lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
 
     def get_order_from_id(self, order_id: int, order_type: OrderType) -> Order:
-        data = self.execute_with_fetch(
-            f'''select c.name, o.ticker, o.amount, o.price, o.expiry_date, o.active 
-                from {order_type.value} as o inner join client as c on o.client_id = c.id 
-                    where o.id = {order_id}''', False)
+        data = self.run_query(queries.SELECT_ORDER[order_type], id=order_id)
         
-        return Order(data[0], order_type, data[1], data[2], data[3], data[4], data[5])
+        return Order(data[0], order_type, data[1], data[2], data[3], from_epoch_ms(data[4]), data[5])
 
-    def get_stock_owned_by_client(self, client_name: str) -> Dict[str, float]:
-        """Retorna a carteira de ações de um cliente."""
-        command = f"""
-            select ticker, amount from OwnedStock
-            where client_id = (select id from Client where name = '{client_name}')
-        """
-        data = self.execute_with_fetch(command, True)
+    def get_stock_owned_by_client(self, client_id: int) -> Dict[str, float]:
+        """Retorna a carteira de ações de um cliente, pelo id dele no DB."""
+        data = self.run_query(queries.SELECT_PORTFOLIO, client_id=client_id)
         return {entry[0]: entry[1] for entry in data}
 
     def execute_with_fetch(self, command: str, fetch_all: bool, *args, **kwargs):
-        """Executa uma operação no DB."""
+        """Executa uma leitura no DB. Leituras não fazem commit."""
         # print('execute_with_fetch:',command)
+        if self.pooled:
+            # Cada thread tem a sua conexão, então a leitura não precisa esperar as outras
+            cursor = self.get_cursor().execute(command, *args, **kwargs)
+            return cursor.fetchall() if fetch_all else cursor.fetchone()
         with self.db_lock:
             cursor =  self.db_cursor.execute(command, *args, **kwargs)
-            self.db.commit()
             return cursor.fetchall() if fetch_all else cursor.fetchone()
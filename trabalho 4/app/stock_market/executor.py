@@ -0,0 +1,88 @@
+"""Pool de threads com fila limitada para executar as ordens e as varreduras do mercado."""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict
+
+
+class BoundedExecutor:
+    """
+    Pool com um número fixo de threads e uma fila de tarefas de tamanho limitado.
+
+    Quando a fila está cheia, `submit` não cria mais trabalho,
+    o que evita criar milhares de threads durante um pico de ordens.
+
+    :param max_workers: Quantidade de threads que executam as tarefas.
+    :param max_queue: Quantidade máxima de tarefas esperando na fila.
+    """
+    def __init__(self, max_workers: int, max_queue: int):
+        if max_workers < 1 or max_queue < 1:
+            raise ValueError("'max_workers' and 'max_queue' must be at least 1.")
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.tasks = queue.Queue(maxsize=max_queue)
+
+        # Estatísticas das tarefas terminadas
+        self.stats_lock = threading.Lock()
+        self.completed_tasks = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+        self.threads = [
+            threading.Thread(target=self.run, daemon=True)
+            for _ in range(max_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, function: Callable, *args: Any, block: bool = True) -> Future:
+        """
+        Coloca uma tarefa na fila. Retorna um Future com o resultado da tarefa.
+
+        :param function: Função que vai ser executada.
+        :param args: Argumentos da função.
+        :param block: Se a fila está cheia, espera ter espaço ou dá `queue.Full`.
+        """
+        future = Future()
+        self.tasks.put((future, function, args, time.monotonic()), block=block)
+        return future
+
+    def get_queue_depth(self) -> int:
+        """Retorna quantas tarefas estão esperando na fila."""
+        return self.tasks.qsize()
+
+    def get_stats(self) -> Dict[str, float]:
+        """
+        Retorna as estatísticas do pool.
+        A latência é o tempo entre a tarefa entrar na fila e terminar de executar, em segundos.
+        """
+        with self.stats_lock:
+            return {
+                'workers': self.max_workers,
+                'max_queue': self.max_queue,
+                'queue_depth': self.get_queue_depth(),
+                'completed_tasks': self.completed_tasks,
+                'mean_latency': (
+                    self.total_latency / self.completed_tasks if self.completed_tasks else 0.0),
+                'max_latency': self.max_latency
+            }
+
+    def run(self):
+        """Executa as tarefas da fila."""
+        while True:
+            future, function, args, submitted_at = self.tasks.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = function(*args)
+            except Exception as e:
+                print(f"BoundedExecutor: task {function.__name__} failed: {e!r}")
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+            latency = time.monotonic() - submitted_at
+            with self.stats_lock:
+                self.completed_tasks += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
@@ -0,0 +1,117 @@
+"""Agendador que desativa as ordens quando elas expiram."""
+import datetime
+import heapq
+import json
+import threading
+from typing import Callable, Dict, List, Set, Tuple
+
+from . import queries
+from .database import Database
+from .timestamps import from_epoch_ms
+from ..enums import OrderType
+
+# Tamanho mínimo do heap para tirar dele as ordens desagendadas
+COMPACT_MIN_SIZE = 1024
+
+
+class ExpiryScheduler:
+    """
+    Desativa as ordens no momento em que elas expiram.
+
+    Guarda as ordens ativas em um heap ordenado pela data de expiração.
+    Uma thread espera até a próxima expiração e desativa de uma vez
+    todas as ordens que já expiraram, sem precisar varrer as tabelas.
+    As ordens executadas ou canceladas antes de expirar são desagendadas,
+    e só saem do heap quando chegam no topo ou quando o heap é compactado.
+
+    :param db: Banco de dados com as ordens.
+    :param on_expired: Chamada com o tipo e os ids das ordens depois que elas são desativadas.
+    """
+    def __init__(self,
+                 db: Database,
+                 on_expired: Callable[[OrderType, List[int]], None]):
+        self.db = db
+        self.on_expired = on_expired
+        self.heap: List[Tuple[datetime.datetime, str, int]] = []
+        # Ordens do heap que ainda estão agendadas: (tipo, id)
+        self.scheduled: Set[Tuple[str, int]] = set()
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def load(self):
+        """Agenda todas as ordens ativas do DB."""
+        for order_type in OrderType:
+            data = self.db.run_query(queries.SELECT_ACTIVE_ORDER_EXPIRIES[order_type])
+            for order_id, expiry_date in data:
+                self.schedule(order_type, order_id, from_epoch_ms(expiry_date))
+
+    def start(self):
+        """Começa a desativar as ordens agendadas."""
+        self.thread.start()
+
+    def schedule(self,
+                 order_type: OrderType,
+                 order_id: int,
+                 expiry_date: datetime.datetime):
+        """
+        Agenda uma ordem para ser desativada quando expirar.
+
+        :param order_type: Tipo da ordem.
+        :param order_id: Id da ordem no DB.
+        :param expiry_date: Data em que a ordem expira.
+        """
+        entry = (expiry_date, order_type.value, order_id)
+        with self.condition:
+            self.scheduled.add((order_type.value, order_id))
+            heapq.heappush(self.heap, entry)
+            # Se é a próxima a expirar, acorda a thread pra recalcular a espera
+            if self.heap[0] == entry:
+                self.condition.notify()
+
+    def unschedule(self, order_type: OrderType, order_id: int):
+        """
+        Desagenda uma ordem que foi executada ou cancelada antes de expirar.
+        Quando a maior parte do heap é de ordens desagendadas, reconstrói o heap sem elas.
+        """
+        with self.condition:
+            self.scheduled.discard((order_type.value, order_id))
+            if len(self.heap) > max(COMPACT_MIN_SIZE, 2 * len(self.scheduled)):
+                self.heap = [entry for entry in self.heap if entry[1:] in self.scheduled]
+                heapq.heapify(self.heap)
+
+    def pop_expired(self) -> Dict[OrderType, List[int]]:
+        """
+        Espera até alguma ordem expirar e tira do heap todas as que já expiraram.
+        Retorna os ids das ordens expiradas de cada tipo.
+        """
+        with self.condition:
+            while True:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                remaining = (self.heap[0][0] - datetime.datetime.now()).total_seconds()
+                if remaining > 0:
+                    self.condition.wait(remaining)
+                    continue
+                break
+
+            now = datetime.datetime.now()
+            expired = {order_type: [] for order_type in OrderType}
+            while self.heap and self.heap[0][0] <= now:
+                _, order_type, order_id = heapq.heappop(self.heap)
+                if (order_type, order_id) in self.scheduled:
+                    self.scheduled.remove((order_type, order_id))
+                    expired[OrderType(order_type)].append(order_id)
+            return expired
+
+    def run(self):
+        """Fica desativando as ordens conforme elas expiram."""
+        while True:
+            expired = self.pop_expired()
+            for order_type, order_ids in expired.items():
+                if not order_ids:
+                    continue
+                # Só as ordens que ainda estão ativas precisam ser desativadas
+                self.db.run_query(
+                    queries.DEACTIVATE_ACTIVE_ORDERS[order_type], ids=json.dumps(order_ids))
+                self.on_expired(order_type, order_ids)
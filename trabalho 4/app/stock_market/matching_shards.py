@@ -0,0 +1,65 @@
+"""Execução de ordens com um único worker por grupo de ações."""
+import zlib
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List
+
+from .executor import BoundedExecutor
+
+
+class NullLock:
+    """
+    Trava que nunca bloqueia.
+    Usada no lugar das travas por ação quando cada ação já tem um único worker,
+    que executa os comandos daquela ação um de cada vez.
+    """
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        return True
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return False
+
+
+class MatchingShards:
+    """
+    Conjunto de workers de execução de ordens.
+
+    Cada ação pertence a um único worker, escolhido pelo hash do nome da ação.
+    Cada worker tem uma fila de comandos e executa os comandos na ordem em que chegaram,
+    então as ordens da mesma ação são executadas em uma ordem determinística
+    e ações de workers diferentes são executadas em paralelo sem disputar travas.
+
+    :param num_shards: Quantidade de workers.
+    :param max_queue: Quantidade máxima de comandos esperando na fila de cada worker.
+    """
+    def __init__(self, num_shards: int, max_queue: int):
+        if num_shards < 1:
+            raise ValueError("'num_shards' must be at least 1.")
+        # Cada worker é um pool de uma thread só, que executa os comandos em ordem
+        self.shards = [BoundedExecutor(1, max_queue) for _ in range(num_shards)]
+
+    def get_shard(self, ticker: str) -> int:
+        """Retorna o índice do worker responsável por uma ação."""
+        # crc32 para a distribuição não depender do hash aleatório do python
+        return zlib.crc32(ticker.encode()) % len(self.shards)
+
+    def submit(self, ticker: str, function: Callable, *args: Any, block: bool = True) -> Future:
+        """
+        Coloca um comando na fila do worker de uma ação.
+        Retorna um Future com o resultado do comando.
+
+        :param ticker: Ação que o comando vai modificar.
+        :param function: Função que vai ser executada pelo worker.
+        :param args: Argumentos da função.
+        :param block: Se a fila do worker está cheia, espera ter espaço ou dá `queue.Full`.
+        """
+        return self.shards[self.get_shard(ticker)].submit(function, *args, block=block)
+
+    def get_stats(self) -> List[Dict[str, float]]:
+        """Retorna as estatísticas de cada worker. Ver `BoundedExecutor.get_stats`."""
+        return [shard.get_stats() for shard in self.shards]
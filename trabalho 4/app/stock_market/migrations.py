@@ -0,0 +1,188 @@
+"""
+Migrações do esquema do banco de dados do stock market.
+
+A versão do esquema fica no `user_version` do sqlite.
+Cada migração leva o esquema da versão anterior para a sua versão,
+e as migrações que o DB ainda não tem são aplicadas em ordem ao iniciar o mercado.
+Migrações novas sempre vão no fim da lista, e as que já existem nunca são alteradas.
+"""
+import sqlite3
+from typing import Callable, List, NamedTuple
+
+from .timestamps import text_to_epoch_ms
+
+
+class Migration(NamedTuple):
+    """Uma alteração do esquema. `apply` recebe a conexão, dentro de uma transação."""
+    version: int
+    description: str
+    apply: Callable[[sqlite3.Connection], None]
+
+
+def statements(*commands: str) -> Callable[[sqlite3.Connection], None]:
+    """Cria uma migração que só executa comandos SQL."""
+    def apply(connection: sqlite3.Connection):
+        for command in commands:
+            connection.execute(command)
+    return apply
+
+
+def merge_duplicate_clients(connection: sqlite3.Connection):
+    """
+    Junta os clientes com o mesmo nome no de menor id, para poder criar o índice único.
+    As ordens e as carteiras dos clientes repetidos passam para o cliente que fica.
+    """
+    duplicates = connection.execute(
+        '''select c.id, (select min(id) from Client where name = c.name) as kept_id
+           from Client as c
+           where c.id != (select min(id) from Client where name = c.name)''').fetchall()
+    for client_id, kept_id in duplicates:
+        for table in ('BuyOrder', 'SellOrder', 'OwnedStock'):
+            connection.execute(
+                f'update {table} set client_id = :kept_id where client_id = :client_id',
+                {'kept_id': kept_id, 'client_id': client_id})
+        connection.execute('delete from Client where id = :id', {'id': client_id})
+
+
+def merge_duplicate_owned_stock(connection: sqlite3.Connection):
+    """
+    Deixa só uma linha por ação na carteira de cada cliente, para poder criar o índice único.
+    Fica a linha de menor id, que é a que os participantes atualizam,
+    com a soma das quantidades de todas as linhas repetidas.
+    """
+    connection.execute(
+        '''update OwnedStock
+           set amount = (select sum(amount) from OwnedStock as o
+                         where o.client_id is OwnedStock.client_id and o.ticker is OwnedStock.ticker)
+           where id in (select min(id) from OwnedStock group by client_id, ticker having count(*) > 1)''')
+    connection.execute(
+        '''delete from OwnedStock
+           where id not in (select min(id) from OwnedStock group by client_id, ticker)''')
+
+
+def find_invalid_times(connection: sqlite3.Connection) -> List[str]:
+    """Retorna as datas em texto das ordens e das transações que não estão no formato `DATETIME_FORMAT`."""
+    invalid = []
+    for table, column in (
+            ('BuyOrder', 'expiry_date'), ('SellOrder', 'expiry_date'), ('StockTransaction', 'datetime')):
+        for row_id, value in connection.execute(f'select id, {column} from {table}'):
+            try:
+                text_to_epoch_ms(value)
+            except (TypeError, ValueError):
+                invalid.append(f'{table}.{column} (id {row_id}): {value!r}')
+    return invalid
+
+
+def store_times_as_epoch_ms(connection: sqlite3.Connection):
+    """
+    Troca as datas em texto das ordens e das transações por milissegundos desde a época.
+    As colunas são declaradas como `text`, que converteria os inteiros de volta para texto,
+    então as tabelas são recriadas com as colunas `integer`, na mesma ordem de antes.
+    Se alguma data não está no formato `DATETIME_FORMAT`, não altera nada e dá ValueError,
+    para que as linhas sejam corrigidas antes de iniciar o mercado de novo.
+    """
+    invalid = find_invalid_times(connection)
+    if invalid:
+        raise ValueError(
+            f"Can't convert {len(invalid)} dates to epoch milliseconds, "
+            f"fix them in the DB and restart: {'; '.join(invalid)}")
+
+    connection.create_function('text_to_epoch_ms', 1, text_to_epoch_ms, deterministic=True)
+    sequences = dict(connection.execute('select name, seq from sqlite_sequence').fetchall())
+    # Tabelas que sobraram de uma execução interrompida antes das migrações serem atômicas
+    for table in ('BuyOrder', 'SellOrder', 'StockTransaction'):
+        connection.execute(f'drop table if exists {table}New')
+    for table in ('BuyOrder', 'SellOrder'):
+        connection.execute(
+            f'''create table {table}New (
+                    id integer primary key autoincrement, client_id integer, ticker text,
+                    amount real, price real, expiry_date integer, active integer,
+                    foreign key (client_id) references Client(id))''')
+        connection.execute(
+            f'''insert into {table}New
+                select id, client_id, ticker, amount, price, text_to_epoch_ms(expiry_date), active
+                from {table}''')
+    connection.execute(
+        '''create table StockTransactionNew (
+               id integer primary key autoincrement, sell_id integer, buy_id integer,
+               amount real, price real, datetime integer,
+               foreign key (sell_id) references SellOrder(id),
+               foreign key (buy_id) references BuyOrder(id))''')
+    connection.execute(
+        '''insert into StockTransactionNew
+           select id, sell_id, buy_id, amount, price, text_to_epoch_ms(datetime)
+           from StockTransaction''')
+
+    for table in ('BuyOrder', 'SellOrder', 'StockTransaction'):
+        connection.execute(f'drop table {table}')
+        connection.execute(f'alter table {table}New rename to {table}')
+        # Mantém o contador de ids, para não reaproveitar ids de linhas apagadas
+        if table in sequences:
+            connection.execute(
+                'update sqlite_sequence set seq = :seq where name = :name',
+                {'seq': sequences[table], 'name': table})
+
+    # Os índices são apagados junto com as tabelas antigas
+    for command in (
+            'create index BuyOrderActiveTickerPrice on BuyOrder (active, ticker, price)',
+            'create index SellOrderActiveTickerPrice on SellOrder (active, ticker, price)',
+            'create index BuyOrderClientActive on BuyOrder (client_id, active)',
+            'create index SellOrderClientActive on SellOrder (client_id, active)',
+            'create index StockTransactionDatetime on StockTransaction (datetime)'):
+        connection.execute(command)
+
+
+def store_quote_times_as_epoch_ms(connection: sqlite3.Connection):
+    """
+    Troca o momento das cotações do histórico de segundos para milissegundos desde a época,
+    como as outras datas do DB. A tabela é recriada com a coluna `integer`,
+    porque a coluna `real` guardaria os inteiros como números de ponto flutuante.
+    """
+    connection.execute('drop table if exists QuoteHistoryNew')
+    connection.execute(
+        '''create table QuoteHistoryNew (
+               ticker text not null,
+               time integer not null,
+               price real not null)''')
+    connection.execute(
+        '''insert into QuoteHistoryNew
+           select ticker, cast(round(time * 1000) as integer), price from QuoteHistory''')
+    connection.execute('drop table QuoteHistory')
+    connection.execute('alter table QuoteHistoryNew rename to QuoteHistory')
+    connection.execute('create index QuoteHistoryTickerTime on QuoteHistory (ticker, time)')
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(
+        1,
+        'Tables of the quote caches',
+        statements(
+            '''create table if not exists TickerCache (
+                   ticker text primary key,
+                   exists_ integer not null,
+                   checked_at real not null)''',
+            '''create table if not exists QuoteHistory (
+                   ticker text not null,
+                   time real not null,
+                   price real not null)''',
+            'create index if not exists QuoteHistoryTickerTime on QuoteHistory (ticker, time)')),
+    Migration(2, 'Merge clients with the same name', merge_duplicate_clients),
+    Migration(3, 'Merge repeated portfolio entries', merge_duplicate_owned_stock),
+    Migration(
+        4,
+        'Indexes of the hot queries',
+        statements(
+            'create unique index ClientName on Client (name)',
+            'create unique index OwnedStockClientTicker on OwnedStock (client_id, ticker)',
+            # Varredura das ordens ativas e livro de ofertas, por ação e preço
+            'create index BuyOrderActiveTickerPrice on BuyOrder (active, ticker, price)',
+            'create index SellOrderActiveTickerPrice on SellOrder (active, ticker, price)',
+            # Ordens de um cliente
+            'create index BuyOrderClientActive on BuyOrder (client_id, active)',
+            'create index SellOrderClientActive on SellOrder (client_id, active)',
+            # Transações a partir de uma data
+            'create index StockTransactionDatetime on StockTransaction (datetime)')),
+    Migration(5, 'Store order expiries and transaction times as epoch milliseconds',
+              store_times_as_epoch_ms),
+    Migration(6, 'Store quote history times as epoch milliseconds', store_quote_times_as_epoch_ms),
+]
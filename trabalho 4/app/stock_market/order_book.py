@@ -0,0 +1,194 @@
+"""Livro de ofertas em memória, usado para casar as ordens sem consultar o DB."""
+import bisect
+import datetime
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from ..enums import OrderType
+
+
+class BookOrder:
+    """
+    Ordem ativa guardada no livro de ofertas.
+
+    :param id_: Id da ordem no banco de dados.
+    :param type_: Tipo da ordem (compra ou venda).
+    :param client_id: Id no DB do cliente que criou a ordem.
+    :param client_name: Nome do cliente que criou a ordem.
+    :param ticker: Nome da ação.
+    :param amount: Quantidade de ações que ainda falta transacionar.
+    :param price: Preço máximo de compra ou preço mínimo de venda.
+    :param expiry_date: Data em que a ordem expira.
+    """
+    def __init__(self,
+                 id_: int,
+                 type_: OrderType,
+                 client_id: int,
+                 client_name: str,
+                 ticker: str,
+                 amount: float,
+                 price: float,
+                 expiry_date: datetime.datetime):
+        self.id = id_
+        self.type = type_
+        self.client_id = client_id
+        self.client_name = client_name
+        self.ticker = ticker
+        self.amount = amount
+        self.price = price
+        self.expiry_date = expiry_date
+
+    def __repr__(self):
+        return(
+            f"BookOrder("
+            f"id_={self.id}, "
+            f"type_={self.type}, "
+            f"client_name={self.client_name}, "
+            f"ticker={self.ticker}, "
+            f"amount={self.amount}, "
+            f"price={self.price}, "
+            f"expiry_date={self.expiry_date}"
+            ")"
+        )
+
+
+class OrderBook:
+    """
+    Livro de ofertas de uma ação.
+
+    Cada lado (compra e venda) tem uma lista ordenada com os preços que têm ordens
+    e, para cada preço, uma fila FIFO com as ordens naquele preço.
+    Assim encontrar as ordens que casam com uma ordem nova é uma busca binária.
+
+    :param ticker: Nome da ação.
+    """
+    def __init__(self, ticker: str):
+        self.ticker = ticker
+        self.lock = threading.Lock()
+        # Preços em ordem crescente de cada lado do livro
+        self.prices: Dict[OrderType, List[float]] = {OrderType.BUY: [], OrderType.SELL: []}
+        # Fila de ordens de cada preço, na ordem em que entraram no livro
+        self.levels: Dict[OrderType, Dict[float, 'OrderedDict[int, BookOrder]']] = {
+            OrderType.BUY: {}, OrderType.SELL: {}}
+
+    def add(self, order: BookOrder):
+        """Coloca uma ordem no fim da fila do seu preço."""
+        with self.lock:
+            levels = self.levels[order.type]
+            if order.price not in levels:
+                bisect.insort(self.prices[order.type], order.price)
+                levels[order.price] = OrderedDict()
+            levels[order.price][order.id] = order
+
+    def remove(self, order: BookOrder) -> bool:
+        """Tira uma ordem do livro. Retorna se a ordem estava no livro."""
+        with self.lock:
+            levels = self.levels[order.type]
+            level = levels.get(order.price)
+            if level is None or level.pop(order.id, None) is None:
+                return False
+            # Se o preço ficou sem ordens, tira ele da lista de preços
+            if not level:
+                del levels[order.price]
+                prices = self.prices[order.type]
+                del prices[bisect.bisect_left(prices, order.price)]
+            return True
+
+    def get_matching(self,
+                     order_type: OrderType,
+                     price: float,
+                     amount: float) -> List[BookOrder]:
+        """
+        Retorna as ordens que podem ser executadas com uma ordem nova,
+        em ordem de prioridade (melhor preço e, no mesmo preço, a mais antiga).
+        Para de procurar quando as ordens encontradas já cobrem `amount`.
+
+        :param order_type: Tipo da ordem nova.
+        :param price: Preço com que a ordem nova quer transacionar.
+        :param amount: Quantidade de ações da ordem nova.
+        """
+        matching_type = order_type.get_matching()
+        now = datetime.datetime.now()
+        matching = []
+        total = 0
+        with self.lock:
+            prices = self.prices[matching_type]
+            levels = self.levels[matching_type]
+            # Quem vende quer as compras de maior preço,
+            # quem compra quer as vendas de menor preço
+            if order_type == OrderType.SELL:
+                matching_prices = reversed(prices[bisect.bisect_left(prices, price):])
+            else:
+                matching_prices = prices[:bisect.bisect_right(prices, price)]
+            for level_price in matching_prices:
+                for book_order in levels[level_price].values():
+                    # Ordens que expiraram mas ainda não foram tiradas do livro são ignoradas
+                    if book_order.expiry_date <= now:
+                        continue
+                    matching.append(book_order)
+                    total += book_order.amount
+                    if total >= amount:
+                        return matching
+        return matching
+
+
+class OrderBooks:
+    """
+    Conjunto dos livros de ofertas de todas as ações.
+    Mantém um índice das ordens pelo id para achar o livro de cada ordem.
+    """
+    def __init__(self):
+        self.books: Dict[str, OrderBook] = {}
+        self.orders: Dict[Tuple[OrderType, int], BookOrder] = {}
+        self.lock = threading.Lock()
+
+    def get_book(self, ticker: str) -> OrderBook:
+        """Retorna o livro de uma ação, criando um novo se ainda não existe."""
+        with self.lock:
+            if ticker not in self.books:
+                self.books[ticker] = OrderBook(ticker)
+            return self.books[ticker]
+
+    def get(self, order_type: OrderType, order_id: int) -> Optional[BookOrder]:
+        """Retorna uma ordem do livro pelo id, ou None se ela não está no livro."""
+        with self.lock:
+            return self.orders.get((order_type, order_id))
+
+    def add(self, order: BookOrder):
+        """
+        Coloca uma ordem no livro.
+        Se ela já estava no livro com o mesmo preço, só atualiza a quantidade,
+        mantendo a posição dela na fila.
+        """
+        with self.lock:
+            old_order = self.orders.get((order.type, order.id))
+            if old_order is not None and old_order.price == order.price:
+                old_order.amount = order.amount
+                return
+        if old_order is not None:
+            self.remove(order.type, order.id)
+        self.get_book(order.ticker).add(order)
+        with self.lock:
+            self.orders[(order.type, order.id)] = order
+
+    def remove(self, order_type: OrderType, order_id: int) -> Optional[BookOrder]:
+        """Tira uma ordem do livro. Retorna a ordem tirada, ou None se não estava no livro."""
+        with self.lock:
+            order = self.orders.pop((order_type, order_id), None)
+        if order is not None:
+            self.get_book(order.ticker).remove(order)
+        return order
+
+    def get_matching(self,
+                     order_type: OrderType,
+                     ticker: str,
+                     price: float,
+                     amount: float) -> List[BookOrder]:
+        """Retorna as ordens que casam com uma ordem nova. Ver `OrderBook.get_matching`."""
+        return self.get_book(ticker).get_matching(order_type, price, amount)
+
+    def load(self, orders: Iterable[BookOrder]):
+        """Coloca um conjunto de ordens no livro. Usado para carregar as ordens do DB."""
+        for order in orders:
+            self.add(order)
@@ -0,0 +1,37 @@
+"""Tarefa executada periodicamente em uma thread própria."""
+import threading
+from typing import Callable
+
+
+class PeriodicTask:
+    """
+    Executa uma função periodicamente em uma thread.
+    Também pode ser disparada manualmente, sem esperar o fim do período.
+    Uma execução nunca começa antes da anterior terminar.
+
+    :param function: Função que vai ser executada, sem argumentos.
+    :param period: Tempo entre o fim de uma execução e o começo da próxima, em segundos.
+    """
+    def __init__(self, function: Callable[[], None], period: float):
+        self.function = function
+        self.period = period
+        self.triggered = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        """Começa a executar a tarefa."""
+        self.thread.start()
+
+    def trigger(self):
+        """Pede para a tarefa executar agora."""
+        self.triggered.set()
+
+    def run(self):
+        """Fica executando a tarefa a cada período ou quando ela é disparada."""
+        while True:
+            self.triggered.wait(self.period)
+            self.triggered.clear()
+            try:
+                self.function()
+            except Exception as e:
+                print(f"PeriodicTask: {self.function.__name__} failed: {e!r}")
@@ -0,0 +1,191 @@
+"""
+Consultas ao banco de dados do stock market.
+
+Todas as consultas usam parâmetros nomeados em vez de colocar os valores no texto,
+então o texto de cada consulta é sempre o mesmo e o sqlite reaproveita a consulta compilada.
+As consultas que dependem do tipo da ordem são dicionários {OrderType: Query}.
+Listas de valores são passadas como um texto JSON e lidas com `json_each`.
+Datas são inteiros em milissegundos desde a época (ver `timestamps`).
+"""
+import re
+from enum import Enum
+from typing import Dict, List, NamedTuple
+
+from ..enums import OrderType
+
+
+class Fetch(Enum):
+    """O que uma consulta retorna."""
+    NONE = 'none'  # Escrita, retorna o id da última linha inserida
+    ONE = 'one'    # Leitura, retorna a primeira linha
+    ALL = 'all'    # Leitura, retorna todas as linhas
+
+
+class Query(NamedTuple):
+    """Consulta com nome, texto SQL com parâmetros nomeados e o que ela retorna."""
+    name: str
+    sql: str
+    fetch: Fetch
+
+
+def per_order_type(name: str, sql: str, fetch: Fetch) -> Dict[OrderType, Query]:
+    """Cria uma consulta para cada tabela de ordens. `sql` usa `{table}` no lugar do nome da tabela."""
+    return {
+        order_type: Query(f'{name}[{order_type.value}]', sql.format(table=order_type.value), fetch)
+        for order_type in OrderType}
+
+
+# Clientes
+SELECT_CLIENTS = Query(
+    'select_clients', 'select id, name from Client', Fetch.ALL)
+INSERT_CLIENT = Query(
+    'insert_client', 'insert into Client (name) values (:name)', Fetch.NONE)
+
+# Ordens
+SELECT_ORDER = per_order_type(
+    'select_order',
+    '''select c.name, o.ticker, o.amount, o.price, o.expiry_date, o.active
+       from {table} as o inner join Client as c on o.client_id = c.id
+       where o.id = :id''',
+    Fetch.ONE)
+SELECT_ORDER_WITH_CLIENT = per_order_type(
+    'select_order_with_client',
+    '''select o.*, c.name
+       from {table} as o inner join Client as c on o.client_id = c.id
+       where o.id = :id''',
+    Fetch.ONE)
+SELECT_ACTIVE_ORDERS_WITH_CLIENT = per_order_type(
+    'select_active_orders_with_client',
+    '''select o.*, c.name
+       from {table} as o inner join Client as c on o.client_id = c.id
+       where o.active = 1''',
+    Fetch.ALL)
+SELECT_ACTIVE_CLIENT_ORDERS_WITH_CLIENT = per_order_type(
+    'select_active_client_orders_with_client',
+    '''select o.*, c.name
+       from {table} as o inner join Client as c on o.client_id = c.id
+       where o.active = 1 and c.name != 'Market' ''',
+    Fetch.ALL)
+SELECT_ACTIVE_ORDER_EXPIRIES = per_order_type(
+    'select_active_order_expiries',
+    'select id, expiry_date from {table} where active = 1',
+    Fetch.ALL)
+SELECT_CLIENT_ORDERS = per_order_type(
+    'select_client_orders',
+    'select * from {table} where client_id = :client_id and (active = 1 or not :active_only)',
+    Fetch.ALL)
+INSERT_ORDER = per_order_type(
+    'insert_order',
+    '''insert into {table} (ticker, amount, price, expiry_date, client_id, active)
+       values (:ticker, :amount, :price, :expiry_date, :client_id, :active)''',
+    Fetch.NONE)
+DEACTIVATE_ORDER = per_order_type(
+    'deactivate_order',
+    'update {table} set active = 0 where id = :id',
+    Fetch.NONE)
+# O '+' em `+active` impede o sqlite de usar o índice de `active`, que percorreria todas as
+# ordens ativas, e faz ele buscar cada ordem pelo id
+DEACTIVATE_ACTIVE_ORDERS = per_order_type(
+    'deactivate_active_orders',
+    'update {table} set active = 0 where id in (select value from json_each(:ids)) and +active = 1',
+    Fetch.NONE)
+UPDATE_ORDER_AMOUNT = per_order_type(
+    'update_order_amount',
+    'update {table} set amount = :amount where id = :id',
+    Fetch.NONE)
+UPDATE_ORDER_AMOUNT_AND_PRICE = per_order_type(
+    'update_order_amount_and_price',
+    'update {table} set amount = :amount, price = :price where id = :id',
+    Fetch.NONE)
+
+# Transações
+INSERT_TRANSACTION = Query(
+    'insert_transaction',
+    '''insert into StockTransaction (sell_id, buy_id, amount, price, datetime)
+       values (:sell_id, :buy_id, :amount, :price, :datetime)''',
+    Fetch.NONE)
+SELECT_CLIENT_TRANSACTIONS = Query(
+    'select_client_transactions',
+    '''select bo.ticker, so.client_id, bo.client_id, t.amount, t.price, t.datetime, t.id
+       from StockTransaction as t
+           inner join SellOrder as so on t.sell_id = so.id
+           inner join BuyOrder as bo on t.buy_id = bo.id
+       where (bo.client_id in (select value from json_each(:client_ids))
+              or so.client_id in (select value from json_each(:client_ids)))
+           and t.datetime >= :from_time''',
+    Fetch.ALL)
+
+# Carteiras
+SELECT_OWNED_STOCK = Query(
+    'select_owned_stock',
+    'select * from OwnedStock where client_id = :client_id and ticker = :ticker',
+    Fetch.ONE)
+SELECT_OWNED_STOCK_ID = Query(
+    'select_owned_stock_id',
+    'select id from OwnedStock where client_id = :client_id and ticker = :ticker',
+    Fetch.ONE)
+SELECT_PORTFOLIO = Query(
+    'select_portfolio',
+    'select ticker, amount from OwnedStock where client_id = :client_id',
+    Fetch.ALL)
+UPDATE_OWNED_STOCK_AMOUNT = Query(
+    'update_owned_stock_amount',
+    'update OwnedStock set amount = :amount where id = :id',
+    Fetch.NONE)
+INSERT_OWNED_STOCK = Query(
+    'insert_owned_stock',
+    'insert into OwnedStock (ticker, amount, client_id) values (:ticker, :amount, :client_id)',
+    Fetch.NONE)
+
+# Histórico de cotações
+INSERT_QUOTE_HISTORY = Query(
+    'insert_quote_history',
+    'insert into QuoteHistory (ticker, time, price) values (:ticker, :time, :price)',
+    Fetch.NONE)
+SELECT_QUOTE_HISTORY = Query(
+    'select_quote_history',
+    '''select time, price from QuoteHistory
+       where ticker = :ticker and time >= :from_time and time < :to_time
+       order by time''',
+    Fetch.ALL)
+
+# Cache de ações
+SELECT_TICKER_CACHE = Query(
+    'select_ticker_cache',
+    'select ticker, exists_, checked_at from TickerCache',
+    Fetch.ALL)
+SELECT_USED_TICKERS = Query(
+    'select_used_tickers',
+    '''select ticker from BuyOrder
+       union select ticker from SellOrder
+       union select ticker from OwnedStock''',
+    Fetch.ALL)
+REPLACE_TICKER_CACHE = Query(
+    'replace_ticker_cache',
+    '''insert or replace into TickerCache (ticker, exists_, checked_at)
+       values (:ticker, :exists, :checked_at)''',
+    Fetch.NONE)
+
+
+# Consultas que precisam usar índice, verificadas ao iniciar o mercado
+HOT_QUERIES: List[Query] = [
+    *SELECT_ORDER_WITH_CLIENT.values(),
+    *SELECT_ACTIVE_ORDERS_WITH_CLIENT.values(),
+    *SELECT_CLIENT_ORDERS.values(),
+    *DEACTIVATE_ACTIVE_ORDERS.values(),
+    SELECT_CLIENT_TRANSACTIONS,
+    SELECT_OWNED_STOCK,
+    SELECT_OWNED_STOCK_ID,
+    SELECT_PORTFOLIO,
+    SELECT_QUOTE_HISTORY,
+]
+# Consultas que precisam buscar as linhas pelo id, também verificadas ao iniciar o mercado
+PRIMARY_KEY_QUERIES: List[Query] = [
+    *SELECT_ORDER_WITH_CLIENT.values(),
+    *DEACTIVATE_ACTIVE_ORDERS.values(),
+]
+
+
+def get_parameter_names(query: Query) -> List[str]:
+    """Retorna os nomes dos parâmetros de uma consulta."""
+    return sorted(set(re.findall(r':(\w+)', query.sql)))
@@ -0,0 +1,231 @@
+"""Cache das cotações obtidas do mercado real."""
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Set, Tuple
+
+from .executor import BoundedExecutor
+
+QuoteFetcher = Callable[[List[str]], Dict[str, Optional[float]]]
+
+
+class QuoteFetchError(Exception):
+    """A busca de cotações não terminou a tempo ou não pôde começar porque o pool está cheio."""
+
+
+class QuoteCache:
+    """
+    Cache das cotações de cada ação, com tempo de validade.
+
+    Se várias threads pedem ao mesmo tempo uma ação que não está no cache,
+    só uma delas busca a cotação no mercado e as outras esperam o resultado dela.
+    As buscas rodam em um pool de threads, que só executa ao mesmo tempo as buscas
+    que a fonte de cotações deixa rodar em paralelo (o yfinance faz um download por vez).
+    Se a busca demora mais que o tempo limite e a ação tem uma cotação antiga no cache,
+    retorna a cotação antiga e a busca continua em segundo plano.
+    Sem cotação antiga, espera a busca até um tempo limite maior e então dá `QuoteFetchError`,
+    para que uma fonte travada não trave quem pediu as cotações.
+    Os pedidos que chegam dentro de uma janela curta são juntados em uma busca só.
+
+    O cache pode ser salvo em um snapshot e carregado de volta quando o mercado reinicia.
+    As cotações carregadas ficam marcadas como antigas e são respondidas na hora
+    enquanto as cotações novas são buscadas em segundo plano.
+
+    :param fetch: Função que busca no mercado as cotações de um conjunto de ações.
+    :param ttl: Tempo em segundos que uma cotação continua válida no cache.
+    :param fetch_workers: Quantidade de buscas que podem rodar ao mesmo tempo.
+    :param fetch_timeout: Tempo máximo em segundos esperando uma busca antes de usar a cotação antiga.
+    :param miss_timeout: Tempo máximo em segundos esperando uma busca quando não tem cotação antiga.
+    :param coalesce_window: Tempo em segundos que uma busca espera por outros pedidos antes de começar.
+    """
+    def __init__(self,
+                 fetch: QuoteFetcher,
+                 ttl: float,
+                 fetch_workers: int = 4,
+                 fetch_timeout: float = 2.0,
+                 coalesce_window: float = 0.01,
+                 miss_timeout: float = 15.0):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.fetch_timeout = fetch_timeout
+        self.miss_timeout = miss_timeout
+        self.coalesce_window = coalesce_window
+        # Ações esperando a próxima busca, junto com os Futures delas
+        self.pending: Dict[str, Future] = {}
+        self.fetcher = BoundedExecutor(fetch_workers, 64)
+        # {ticker: (cotação, momento em que foi buscada)}
+        self.entries: Dict[str, Tuple[Optional[float], float]] = {}
+        # Buscas em andamento, para as outras threads esperarem
+        self.in_flight: Dict[str, Future] = {}
+        # Ações carregadas do snapshot que ainda não foram buscadas de novo
+        self.warming: Set[str] = set()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        # Erros que esperaram a busca de outra thread em vez de buscar no mercado
+        self.shared_misses = 0
+        # Buscas que demoraram demais e foram respondidas com a cotação antiga
+        self.stale_quotes = 0
+        # Histograma do tamanho das buscas, {'<=N': quantidade de buscas com até N ações}
+        self.batch_sizes: Dict[str, int] = {}
+
+    def get_quotes(self, tickers: Iterable[str]) -> Dict[str, Optional[float]]:
+        """Retorna a cotação de um conjunto de ações, buscando no mercado só as que precisam."""
+        tickers = list(tickers)
+        quotes: Dict[str, Optional[float]] = {}
+        to_fetch: Dict[str, Future] = {}
+        waiting: Dict[str, Future] = {}
+        stale: Dict[str, Optional[float]] = {}
+        now = time.monotonic()
+        with self.lock:
+            for ticker in set(tickers):
+                entry = self.entries.get(ticker)
+                if entry is not None and now - entry[1] < self.ttl:
+                    quotes[ticker] = entry[0]
+                    self.hits += 1
+                    continue
+                self.misses += 1
+                # Cotação do snapshot, a busca nova já está em andamento
+                if entry is not None and ticker in self.warming:
+                    quotes[ticker] = entry[0]
+                    self.stale_quotes += 1
+                    continue
+                if entry is not None:
+                    stale[ticker] = entry[0]
+                # Se outra thread já está buscando, espera ela
+                if ticker in self.in_flight:
+                    waiting[ticker] = self.in_flight[ticker]
+                    self.shared_misses += 1
+                else:
+                    to_fetch[ticker] = self.in_flight[ticker] = Future()
+                    waiting[ticker] = to_fetch[ticker]
+
+        if to_fetch:
+            self.schedule_fetch(to_fetch)
+
+        deadline = now + self.fetch_timeout
+        miss_deadline = now + self.miss_timeout
+        for ticker, future in waiting.items():
+            # Sem cotação antiga não tem o que responder, então espera a busca terminar
+            if ticker not in stale:
+                try:
+                    quotes[ticker] = future.result(max(0.0, miss_deadline - time.monotonic()))
+                except TimeoutError:
+                    raise QuoteFetchError(f"Quote fetch for {ticker} didn't finish in time")
+                continue
+            try:
+                quotes[ticker] = future.result(max(0.0, deadline - time.monotonic()))
+            except TimeoutError:
+                quotes[ticker] = stale[ticker]
+                with self.lock:
+                    self.stale_quotes += 1
+
+        return {ticker: quotes[ticker] for ticker in tickers}
+
+    def schedule_fetch(self, to_fetch: Dict[str, Future]):
+        """
+        Coloca as ações na próxima busca, começando uma busca nova se não tem nenhuma esperando.
+        Se o pool está cheio, a busca não começa e as threads esperando recebem `QuoteFetchError`.
+        """
+        with self.lock:
+            start_batch = not self.pending
+            self.pending.update(to_fetch)
+        if not start_batch:
+            return
+        try:
+            self.fetcher.submit(self.fetch_batch, block=False)
+        except queue.Full:
+            with self.lock:
+                batch, self.pending = self.pending, {}
+                for ticker in batch:
+                    self.in_flight.pop(ticker, None)
+                    self.warming.discard(ticker)
+            for future in batch.values():
+                future.set_exception(QuoteFetchError("Too many quote fetches waiting"))
+
+    def fetch_batch(self):
+        """Espera a janela juntando pedidos e busca todas as ações pedidas nela de uma vez."""
+        if self.coalesce_window > 0:
+            time.sleep(self.coalesce_window)
+        with self.lock:
+            batch, self.pending = self.pending, {}
+            # Agrupa em potências de 2 para o histograma ter poucas faixas
+            bucket = f'<={1 << (len(batch) - 1).bit_length()}'
+            self.batch_sizes[bucket] = self.batch_sizes.get(bucket, 0) + 1
+        self.fetch_and_store(batch)
+
+    def fetch_and_store(self, to_fetch: Dict[str, Future]) -> Dict[str, Optional[float]]:
+        """Busca as cotações no mercado, guarda no cache e avisa as threads que estavam esperando."""
+        try:
+            fetched = self.fetch(list(to_fetch.keys()))
+        except Exception as e:
+            with self.lock:
+                for ticker in to_fetch:
+                    self.in_flight.pop(ticker, None)
+                    self.warming.discard(ticker)
+            for future in to_fetch.values():
+                future.set_exception(e)
+            raise
+
+        fetched_at = time.monotonic()
+        quotes = {ticker: fetched.get(ticker) for ticker in to_fetch}
+        with self.lock:
+            for ticker, quote in quotes.items():
+                self.entries[ticker] = (quote, fetched_at)
+                self.in_flight.pop(ticker, None)
+                self.warming.discard(ticker)
+        for ticker, future in to_fetch.items():
+            future.set_result(quotes[ticker])
+        return quotes
+
+    def get_snapshot(self) -> Dict[str, Tuple[Optional[float], float]]:
+        """Retorna as cotações do cache, com o momento em que foram buscadas em segundos desde a época."""
+        # Converte do relógio monotônico para o relógio do sistema, que continua valendo depois de reiniciar
+        offset = time.time() - time.monotonic()
+        with self.lock:
+            return {
+                ticker: (quote, fetched_at + offset)
+                for ticker, (quote, fetched_at) in self.entries.items()}
+
+    def load_snapshot(self, snapshot: Mapping[str, Sequence[Any]], max_age: float) -> int:
+        """
+        Carrega cotações salvas por `get_snapshot` como cotações antigas
+        e começa a buscar as cotações novas delas em segundo plano.
+        Retorna quantas cotações foram carregadas.
+
+        :param snapshot: Cotações salvas.
+        :param max_age: Idade máxima em segundos das cotações carregadas.
+            As mais antigas são ignoradas, porque o preço delas não serve mais para executar ordens.
+        """
+        # Coloca como vencidas, para serem respondidas só enquanto a busca nova não termina
+        expired_at = time.monotonic() - self.ttl
+        oldest = time.time() - max_age
+        loaded = 0
+        to_fetch: Dict[str, Future] = {}
+        with self.lock:
+            for ticker, (quote, fetched_at) in snapshot.items():
+                if ticker in self.entries or fetched_at < oldest:
+                    continue
+                self.entries[ticker] = (quote, expired_at)
+                self.warming.add(ticker)
+                loaded += 1
+                if ticker not in self.in_flight:
+                    to_fetch[ticker] = self.in_flight[ticker] = Future()
+        if to_fetch:
+            self.schedule_fetch(to_fetch)
+        return loaded
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Retorna os contadores de acertos e erros do cache e o histograma do tamanho das buscas."""
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'shared_misses': self.shared_misses,
+                'stale_quotes': self.stale_quotes,
+                'cached_tickers': len(self.entries),
+                'batch_sizes': dict(self.batch_sizes),
+                'warming_tickers': len(self.warming)
+            }
@@ -0,0 +1,85 @@
+"""Histórico das cotações obtidas pelo mercado."""
+import datetime
+from typing import Dict, List, Mapping, Optional, Union
+
+import numpy as np
+
+from . import queries
+from .database import Database
+from .timestamps import from_epoch_ms, to_epoch_ms
+from ..consts import DATETIME_FORMAT
+
+
+class QuoteHistory:
+    """
+    Guarda todas as cotações buscadas na tabela QuoteHistory do DB, uma linha por cotação.
+    Só acrescenta linhas, nunca altera.
+    O momento de cada cotação fica em milissegundos desde a época, como as outras datas do DB.
+
+    :param db: Banco de dados do mercado.
+    """
+    def __init__(self, db: Database):
+        self.db = db
+
+    def record(self, quotes: Mapping[str, Optional[float]], date: Optional[datetime.datetime] = None):
+        """
+        Guarda as cotações de um conjunto de ações. Cotações None não são guardadas.
+
+        :param quotes: Cotação de cada ação.
+        :param date: Momento das cotações. Se None, usa o momento atual.
+        """
+        if date is None:
+            date = datetime.datetime.now()
+        time_ms = to_epoch_ms(date)
+        rows = [{'ticker': ticker, 'time': time_ms, 'price': price}
+                for ticker, price in quotes.items() if price is not None]
+        if rows:
+            self.db.run_query_many(queries.INSERT_QUOTE_HISTORY, rows)
+
+    def get_bars(self,
+                 ticker: str,
+                 from_date: datetime.datetime,
+                 to_date: datetime.datetime,
+                 resolution: float) -> List[Dict[str, Union[str, float]]]:
+        """
+        Retorna as barras OHLC (abertura, máxima, mínima e fechamento) de uma ação em um intervalo.
+        Intervalos de tempo sem cotações não têm barra.
+
+        :param ticker: Ação.
+        :param from_date: Começo do intervalo.
+        :param to_date: Fim do intervalo.
+        :param resolution: Duração de cada barra em segundos.
+        """
+        if resolution <= 0:
+            raise ValueError("'resolution' must be positive.")
+        from_ms = to_epoch_ms(from_date)
+        resolution_ms = resolution * 1000
+        data = self.db.run_query(queries.SELECT_QUOTE_HISTORY,
+                                 ticker=ticker, from_time=from_ms, to_time=to_epoch_ms(to_date))
+        if not data:
+            return []
+        times = np.array([row[0] for row in data], dtype=np.int64)
+        prices = np.array([row[1] for row in data], dtype=np.float64)
+
+        # Cada cotação vai para a barra do começo do intervalo dela
+        buckets = np.floor((times - from_ms) / resolution_ms).astype(np.int64)
+        # Como as cotações estão ordenadas, cada barra é um trecho contínuo do vetor
+        bucket_ids, starts = np.unique(buckets, return_index=True)
+        ends = np.append(starts[1:], len(prices)) - 1
+
+        opens = prices[starts]
+        highs = np.maximum.reduceat(prices, starts)
+        lows = np.minimum.reduceat(prices, starts)
+        closes = prices[ends]
+        bar_times = from_ms + bucket_ids * resolution_ms
+
+        return [
+            {
+                'time': from_epoch_ms(int(bar_time)).strftime(DATETIME_FORMAT),
+                'open': float(open_),
+                'high': float(high),
+                'low': float(low),
+                'close': float(close)
+            }
+            for bar_time, open_, high, low, close in zip(bar_times, opens, highs, lows, closes)
+        ]
@@ -0,0 +1,273 @@
+"""
+Fontes de cotações do mercado.
+
+Além do mercado real (yfinance), tem um simulador e uma fonte que reproduz cotações de um arquivo,
+para testar o StockMarket sem acesso à rede.
+Os arquivos de cotações são gravados por `RecordingQuoteProvider`.
+"""
+import gzip
+import json
+import math
+import os
+import random
+import threading
+import time
+from typing import Dict, IO, List, Optional, Sequence
+
+# Tempo em segundos, no ritmo da gravação, entre voltas de um arquivo em que todos os registros têm o mesmo tempo
+REPLAY_LOOP_STEP = 1.0
+# Tempo máximo em segundos de um download do yfinance
+YAHOO_TIMEOUT = 10.0
+
+
+def open_quote_file(path: str, mode: str) -> IO[str]:
+    """Abre um arquivo de cotações, comprimido com gzip se o nome termina em '.gz'."""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't')
+    return open(path, mode)
+
+
+class QuoteProvider:
+    """Interface das fontes de cotações usadas pelo StockMarket."""
+
+    def get_quotes(self, tickers: Sequence[str]) -> Dict[str, Optional[float]]:
+        """Retorna a cotação atual de um conjunto de ações. Ações que não existem têm valor None."""
+        raise NotImplementedError
+
+    def ticker_exists(self, ticker: str) -> bool:
+        """Retorna se uma ação existe."""
+        return self.get_quotes([ticker])[ticker] is not None
+
+
+class YahooQuoteProvider(QuoteProvider):
+    """
+    Cotações do mercado real, usando a API yfinance.
+    O yfinance guarda o resultado dos downloads em variáveis globais,
+    então só um download roda por vez, mesmo com várias buscas ao mesmo tempo.
+
+    :param timeout: Tempo máximo em segundos de cada download.
+    """
+    def __init__(self, timeout: float = YAHOO_TIMEOUT):
+        import yfinance
+        self.yf = yfinance
+        self.timeout = timeout
+        self.lock = threading.Lock()
+
+    def get_quotes(self, tickers: Sequence[str]) -> Dict[str, Optional[float]]:
+        # Dependendo do numero de ações para pegar cotação faz algo diferente
+        # por causa da estrutura de dados que o yfinance usa
+        tickers = list(tickers)
+        if len(tickers) == 0:
+            return {}
+        with self.lock:
+            data = self.yf.download(
+                tickers, period="1d", progress=False, timeout=self.timeout)["Adj Close"]
+        if len(tickers) == 1:
+            quotes = {tickers[0]: round(float(data.values[0]), 2) if len(data.values) > 0 else None}
+        else:
+            quotes: Dict[str, Optional[float]] = {ticker: None for ticker in tickers}
+            for ticker in quotes:
+                quote = data.loc[:, ticker.upper()].values[0]
+                if not math.isnan(quote):
+                    quotes[ticker] = round(float(quote), 2)
+        return quotes
+
+    def ticker_exists(self, ticker: str) -> bool:
+        with self.lock:
+            data = self.yf.download(ticker, period="1d", progress=False, timeout=self.timeout)
+        return len(data) > 0
+
+
+class SimulatedQuoteProvider(QuoteProvider):
+    """
+    Mercado simulado, onde o preço de cada ação é um passeio aleatório.
+    A sequência de preços é determinada pela semente, então duas execuções
+    com a mesma configuração geram os mesmos preços a cada passo.
+
+    :param tickers: Ações que existem no mercado simulado.
+    :param seed: Semente do gerador de números aleatórios.
+    :param tick_rate: Quantidade de passos do passeio por segundo.
+        Se for 0, os preços só mudam chamando `step`.
+    :param volatility: Desvio padrão da variação relativa do preço em cada passo.
+    """
+    def __init__(self,
+                 tickers: Sequence[str],
+                 seed: int = 0,
+                 tick_rate: float = 1.0,
+                 volatility: float = 0.01):
+        self.random = random.Random(seed)
+        self.tick_rate = tick_rate
+        self.volatility = volatility
+        self.prices: Dict[str, float] = {
+            ticker: round(self.random.uniform(5.0, 100.0), 2) for ticker in tickers}
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.ticks = 0
+
+    def step(self):
+        """Avança um passo do passeio aleatório em todas as ações."""
+        with self.lock:
+            self._step()
+
+    def _step(self):
+        # Ordena pra ordem dos números aleatórios não depender da ordem do dicionário
+        for ticker in sorted(self.prices):
+            change = math.exp(self.random.gauss(0.0, self.volatility))
+            self.prices[ticker] = max(0.01, round(self.prices[ticker] * change, 2))
+        self.ticks += 1
+
+    def get_quotes(self, tickers: Sequence[str]) -> Dict[str, Optional[float]]:
+        with self.lock:
+            # Avança os passos que deveriam ter acontecido desde o começo
+            if self.tick_rate > 0:
+                due_ticks = int((time.monotonic() - self.start_time) * self.tick_rate)
+                while self.ticks < due_ticks:
+                    self._step()
+            return {ticker: self.prices.get(ticker) for ticker in tickers}
+
+
+class RecordingQuoteProvider(QuoteProvider):
+    """
+    Grava em um arquivo todas as respostas de outra fonte de cotações,
+    no formato lido por `ReplayQuoteProvider`.
+
+    :param provider: Fonte de onde vêm as cotações.
+    :param path: Caminho do arquivo. Se já existe, acrescenta no fim.
+        Se o nome termina em '.gz', o arquivo é comprimido.
+    """
+    def __init__(self, provider: QuoteProvider, path: str):
+        self.provider = provider
+        self.file = open_quote_file(path, 'a')
+        self.lock = threading.Lock()
+
+    def get_quotes(self, tickers: Sequence[str]) -> Dict[str, Optional[float]]:
+        quotes = self.provider.get_quotes(tickers)
+        record = json.dumps({'time': time.time(), 'quotes': quotes}, separators=(',', ':'))
+        with self.lock:
+            self.file.write(record + '\n')
+            self.file.flush()
+        return quotes
+
+    def ticker_exists(self, ticker: str) -> bool:
+        return self.provider.ticker_exists(ticker)
+
+
+class ReplayQuoteProvider(QuoteProvider):
+    """
+    Reproduz cotações gravadas em um arquivo.
+
+    O arquivo tem um registro JSON por linha, no formato
+    `{"time": <segundos desde a época>, "quotes": {ticker: cotação}}`, em ordem de tempo.
+    A cotação de uma ação é a do último registro reproduzido que tem aquela ação.
+
+    :param path: Caminho do arquivo. Se o nome termina em '.gz', lê comprimido.
+    :param loop: Se volta para o começo do arquivo quando chega no fim.
+    :param speed: Velocidade da reprodução em relação ao tempo em que foi gravado (1 é o mesmo ritmo).
+        Se for None, reproduz o mais rápido possível: cada pedido de cotações avança um registro.
+    """
+    def __init__(self, path: str, loop: bool = False, speed: Optional[float] = 1.0):
+        if speed is not None and speed <= 0:
+            raise ValueError("'speed' must be positive or None.")
+        with open_quote_file(path, 'r') as fp:
+            self.records = [json.loads(line) for line in fp if line.strip()]
+        if not self.records:
+            raise ValueError(f"The replay file \"{path}\" has no records.")
+        self.loop = loop
+        self.speed = speed
+        self.tickers = {ticker for record in self.records for ticker in record['quotes']}
+        # Duração de uma volta do arquivo no modo loop.
+        # Depois do último registro espera o intervalo médio entre os registros antes de voltar ao começo,
+        # ou um passo fixo se todos os registros têm o mesmo tempo
+        duration = self.records[-1]['time'] - self.records[0]['time']
+        step = duration / (len(self.records) - 1) if duration > 0 else REPLAY_LOOP_STEP
+        self.loop_period = duration + step
+        self.lock = threading.Lock()
+        self.restart()
+
+    def restart(self):
+        """Volta a reprodução para o começo do arquivo."""
+        self.next_record = 0
+        self.current: Dict[str, Optional[float]] = {}
+        self.start_time = time.monotonic()
+        self.lap = 0
+
+    def apply_records(self, replay_time: float):
+        """Aplica os registros ainda não reproduzidos da volta atual cujo tempo já chegou."""
+        while (self.next_record < len(self.records)
+                and self.records[self.next_record]['time'] <= replay_time):
+            self.current.update(self.records[self.next_record]['quotes'])
+            self.next_record += 1
+
+    def advance(self):
+        """Aplica os registros cujo tempo já chegou."""
+        if self.speed is None:
+            # O mais rápido possível, um registro por vez
+            if self.next_record >= len(self.records):
+                if not self.loop:
+                    return
+                self.next_record = 0
+            self.current.update(self.records[self.next_record]['quotes'])
+            self.next_record += 1
+            return
+
+        elapsed = (time.monotonic() - self.start_time) * self.speed
+        if self.loop:
+            lap = int(elapsed // self.loop_period)
+            if lap > self.lap:
+                # Termina a volta atual antes de voltar para o começo do arquivo
+                self.apply_records(self.records[-1]['time'])
+                self.next_record = 0
+                self.lap = lap
+            elapsed -= lap * self.loop_period
+        self.apply_records(self.records[0]['time'] + elapsed)
+
+    def get_quotes(self, tickers: Sequence[str]) -> Dict[str, Optional[float]]:
+        with self.lock:
+            self.advance()
+            return {ticker: self.current.get(ticker) for ticker in tickers}
+
+    def ticker_exists(self, ticker: str) -> bool:
+        return ticker in self.tickers
+
+
+def quote_provider_from_env() -> QuoteProvider:
+    """
+    Cria a fonte de cotações configurada nas variáveis de ambiente.
+
+    STOCK_MARKET_QUOTES: 'yahoo' (padrão), 'simulated' ou 'replay'.
+    Para 'simulated':
+        STOCK_MARKET_SIM_TICKERS: Ações separadas por vírgula.
+        STOCK_MARKET_SIM_SEED: Semente (padrão 0).
+        STOCK_MARKET_SIM_TICK_RATE: Passos por segundo (padrão 1).
+    Para 'replay':
+        STOCK_MARKET_REPLAY_FILE: Arquivo com as cotações.
+        STOCK_MARKET_REPLAY_LOOP: '1' para repetir o arquivo quando acabar.
+        STOCK_MARKET_REPLAY_SPEED: Velocidade da reprodução (padrão 1) ou 'asap' para o mais rápido possível.
+    Para qualquer fonte:
+        STOCK_MARKET_RECORD_FILE: Se definido, grava as cotações recebidas nesse arquivo.
+    """
+    provider_name = os.environ.get('STOCK_MARKET_QUOTES', 'yahoo')
+    provider: QuoteProvider
+    if provider_name == 'yahoo':
+        provider = YahooQuoteProvider()
+    elif provider_name == 'simulated':
+        tickers: List[str] = [
+            ticker.strip()
+            for ticker in os.environ.get('STOCK_MARKET_SIM_TICKERS', '').split(',')
+            if ticker.strip()]
+        provider = SimulatedQuoteProvider(
+            tickers,
+            seed=int(os.environ.get('STOCK_MARKET_SIM_SEED', '0')),
+            tick_rate=float(os.environ.get('STOCK_MARKET_SIM_TICK_RATE', '1')))
+    elif provider_name == 'replay':
+        speed = os.environ.get('STOCK_MARKET_REPLAY_SPEED', '1')
+        provider = ReplayQuoteProvider(
+            os.environ['STOCK_MARKET_REPLAY_FILE'],
+            loop=os.environ.get('STOCK_MARKET_REPLAY_LOOP', '0') == '1',
+            speed=None if speed == 'asap' else float(speed))
+    else:
+        raise ValueError(f"Unknown quote provider \"{provider_name}\".")
+
+    if 'STOCK_MARKET_RECORD_FILE' in os.environ:
+        provider = RecordingQuoteProvider(provider, os.environ['STOCK_MARKET_RECORD_FILE'])
+    return provider
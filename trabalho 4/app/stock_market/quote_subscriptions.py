@@ -0,0 +1,96 @@
+"""Envio das cotações para os homebrokers inscritos."""
+import threading
+from typing import Callable, Dict, Iterable, Optional, Set
+
+import Pyro5.api
+import Pyro5.errors
+
+QuoteGetter = Callable[[Iterable[str]], Dict[str, Optional[float]]]
+
+
+class QuoteSubscriptions:
+    """
+    Inscrições dos homebrokers nas cotações de ações.
+
+    A cada envio busca uma vez só as cotações de todas as ações inscritas
+    e manda para cada homebroker só as cotações que mudaram desde o último envio,
+    chamando o método oneway `push_quotes` dele.
+
+    :param get_quotes: Função que retorna as cotações de um conjunto de ações.
+    """
+    def __init__(self, get_quotes: QuoteGetter):
+        self.get_quotes = get_quotes
+        # {uri do homebroker: ações inscritas}
+        self.subscribers: Dict[str, Set[str]] = {}
+        # {uri do homebroker: {ação: última cotação enviada}}
+        self.last_pushed: Dict[str, Dict[str, Optional[float]]] = {}
+        self.lock = threading.Lock()
+        # Só usados pela thread que envia as cotações
+        self.proxies: Dict[str, Pyro5.api.Proxy] = {}
+
+    def subscribe(self, tickers: Iterable[str], callback_uri: str):
+        """Inscreve um homebroker nas cotações de um conjunto de ações."""
+        with self.lock:
+            self.subscribers.setdefault(callback_uri, set()).update(tickers)
+            self.last_pushed.setdefault(callback_uri, {})
+
+    def unsubscribe(self, tickers: Optional[Iterable[str]], callback_uri: str):
+        """
+        Cancela a inscrição de um homebroker nas cotações de um conjunto de ações.
+        Se `tickers` for None, cancela todas as inscrições do homebroker.
+        """
+        with self.lock:
+            if callback_uri not in self.subscribers:
+                return
+            if tickers is None:
+                self.remove_subscriber(callback_uri)
+                return
+            for ticker in tickers:
+                self.subscribers[callback_uri].discard(ticker)
+                self.last_pushed[callback_uri].pop(ticker, None)
+            if not self.subscribers[callback_uri]:
+                self.remove_subscriber(callback_uri)
+
+    def remove_subscriber(self, callback_uri: str):
+        """Remove um homebroker. Precisa estar com `lock`."""
+        self.subscribers.pop(callback_uri, None)
+        self.last_pushed.pop(callback_uri, None)
+
+    def push(self):
+        """Busca as cotações inscritas e envia as que mudaram para cada homebroker."""
+        with self.lock:
+            subscribers = {uri: set(tickers) for uri, tickers in self.subscribers.items()}
+        # Fecha a conexão com os homebrokers que cancelaram a inscrição
+        for uri in list(self.proxies):
+            if uri not in subscribers:
+                self.proxies.pop(uri)._pyroRelease()
+        all_tickers = set().union(*subscribers.values())
+        if not all_tickers:
+            return
+        quotes = self.get_quotes(all_tickers)
+
+        for uri, tickers in subscribers.items():
+            with self.lock:
+                if uri not in self.last_pushed:
+                    continue
+                last_pushed = self.last_pushed[uri]
+                changed = {
+                    ticker: quotes[ticker] for ticker in tickers
+                    if ticker not in last_pushed or last_pushed[ticker] != quotes[ticker]}
+                last_pushed.update(changed)
+            if not changed:
+                continue
+            try:
+                self.get_proxy(uri).push_quotes(changed)
+            except Pyro5.errors.CommunicationError:
+                # O homebroker fechou, para de enviar pra ele
+                print(f"QuoteSubscriptions: dropping unreachable subscriber {uri}")
+                self.proxies.pop(uri, None)
+                with self.lock:
+                    self.remove_subscriber(uri)
+
+    def get_proxy(self, uri: str) -> Pyro5.api.Proxy:
+        """Retorna o proxy de um homebroker, mantendo a conexão aberta entre os envios."""
+        if uri not in self.proxies:
+            self.proxies[uri] = Pyro5.api.Proxy(uri)
+        return self.proxies[uri]
@@ -2,14 +2,16 @@
 Simulador de bolsa de valores.
 """
 import datetime
-import math
+import json
 import os
+import queue
 import sqlite3
 import sys
 import threading
 from threading import Lock
 import time
-from typing import Dict, List, Mapping, Sequence, Optional, Iterable
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Mapping, Sequence, Set, Optional, Iterable, Tuple
 from Pyro5 import client
 
 #os.environ["PYRO_LOGFILE"] = "stockmarket.log"
@@ -17,22 +19,78 @@ from Pyro5 import client
 
 import Pyro5.api as pyro
 from Pyro5.errors import excepthook as pyro_excepthook
-import yfinance as yf
 
+from . import queries
+from .client_directory import ClientDirectory
 from .database import Database
-from .transaction_operations import Coordinator, Participant, MarketParticipant
+from .executor import BoundedExecutor
+from .expiry_scheduler import ExpiryScheduler
+from .matching_shards import MatchingShards, NullLock
+from .order_book import BookOrder, OrderBooks
+from .periodic_task import PeriodicTask
+from .quote_cache import QuoteCache, QuoteFetchError
+from .quote_history import QuoteHistory
+from .quote_providers import QuoteProvider, YahooQuoteProvider
+from .quote_subscriptions import QuoteSubscriptions
+from .ticker_cache import TickerCache
+from .timestamps import from_epoch_ms, text_to_epoch_ms, to_epoch_ms
+from .transaction_operations import Coordinator, Participant, MarketParticipant, TransactionHandle
 from ..consts import DATETIME_FORMAT
-from ..enums import OrderType, MarketErrorCode
+from ..enums import OrderType, MarketErrorCode, TransactionState
 from ..order import Order, Transaction
 
 
 class StockMarket:
     """
     Simulador de bolsa de valores.
-    Usa a API yfinance para obter dados do mercado de ações real.
+    Obtém as cotações de uma fonte de cotações, por padrão o mercado real pela API yfinance.
     Usa um banco de dados sqlite para armazenar os dados de clientes, ordens e transações.
+
+    :param db_path: Caminho do banco de dados.
+    :param pooled_db: Se cada thread usa a sua conexão com o banco de dados, em modo WAL.
+        Ver `Database`.
+    :param group_commit_window: Tempo em segundos que as escritas no banco de dados são juntadas
+        para fazer um commit só. Se for None, cada escrita faz o seu commit.
+    :param matching_shards: Se não for None, executa as ordens em modo particionado,
+        com essa quantidade de workers, cada um responsável por um grupo de ações.
+        Se for None, as ordens são executadas no pool de threads, usando travas por ação.
+    :param max_workers: Quantidade de threads do pool que executa as ordens e as varreduras.
+    :param max_queue: Quantidade máxima de tarefas esperando no pool (e em cada worker).
+        Quando a fila está cheia, novas ordens são recusadas com `MarketErrorCode.BUSY`.
+    :param sweep_period: Tempo entre as varreduras das ordens ativas com o mercado real, em segundos.
+    :param quote_ttl: Tempo em segundos que uma cotação fica no cache antes de buscar de novo.
+    :param quote_fetch_workers: Quantidade de buscas de cotações que podem rodar ao mesmo tempo.
+        A fonte yfinance faz um download por vez, então mais workers só servem para as outras fontes.
+    :param quote_fetch_timeout: Tempo máximo em segundos esperando uma busca de cotações
+        antes de usar a cotação antiga do cache.
+    :param quote_miss_timeout: Tempo máximo em segundos esperando uma busca de cotações sem cotação antiga.
+        Quando passa, as ordens são recusadas com `MarketErrorCode.BUSY`.
+    :param quote_coalesce_window: Tempo em segundos que uma busca de cotações espera
+        para juntar os pedidos de outras threads em uma busca só.
+    :param quote_snapshot_period: Tempo entre os salvamentos do snapshot das cotações, em segundos.
+        O snapshot também é salvo ao fechar e é carregado ao iniciar, ficando ao lado do banco de dados.
+    :param quote_snapshot_max_age: Idade máxima em segundos das cotações carregadas do snapshot.
+    :param quote_push_period: Tempo entre os envios das cotações para os homebrokers inscritos, em segundos.
+    :param quote_provider: Fonte das cotações. Se for None, usa o mercado real (`YahooQuoteProvider`).
     """
-    def __init__(self, db_path: str, use_pyro=True):
+    def __init__(self,
+                 db_path: str,
+                 use_pyro=True,
+                 pooled_db: bool = True,
+                 group_commit_window: Optional[float] = 0.002,
+                 matching_shards: Optional[int] = None,
+                 max_workers: int = 8,
+                 max_queue: int = 256,
+                 sweep_period: float = 5.0,
+                 quote_ttl: float = 1.0,
+                 quote_fetch_workers: int = 4,
+                 quote_fetch_timeout: float = 2.0,
+                 quote_coalesce_window: float = 0.01,
+                 quote_miss_timeout: float = 15.0,
+                 quote_push_period: float = 1.0,
+                 quote_snapshot_period: float = 60.0,
+                 quote_snapshot_max_age: float = 300.0,
+                 quote_provider: Optional[QuoteProvider] = None):
         # Checa se o banco de dados existe
         if not os.path.exists(db_path):
             raise ValueError(f"The database file \"{db_path}\" doesn't exist.")
@@ -50,7 +108,14 @@ class StockMarket:
         pyro.register_dict_to_class('Transaction', Transaction.from_dict)
 
         # Conecta com o banco de dados e inicializa
-        self.db = Database(db_path)
+        self.db = Database(db_path, pooled=pooled_db, group_commit_window=group_commit_window)
+        self.db.migrate()
+        for regression in self.db.check_query_plans():
+            print(f"Query plan regression: {regression}")
+
+        # Nome e id de todos os clientes, para validar as ordens sem consultar o DB
+        self.clients = ClientDirectory(self.db)
+        self.clients.load()
 
         # Comentar pra db persistente
         # self.db.execute('delete from BuyOrder')
@@ -60,7 +125,52 @@ class StockMarket:
         # self.db.execute('delete from StockTransaction')
         self.add_client("Market")
 
-        self.yahoo_lock = threading.Lock()
+        self.quote_provider = quote_provider if quote_provider is not None else YahooQuoteProvider()
+        self.quote_cache = QuoteCache(
+            self.fetch_quotes, quote_ttl, quote_fetch_workers, quote_fetch_timeout,
+            quote_coalesce_window, quote_miss_timeout)
+
+        # Todas as cotações buscadas, para gráficos e testes com dados passados.
+        # Criado antes de carregar o snapshot, que já começa a buscar cotações
+        self.quote_history = QuoteHistory(self.db)
+
+        # Começa com as últimas cotações conhecidas, enquanto as novas são buscadas
+        self.quote_snapshot_path = os.path.splitext(db_path)[0] + '_quotes.json'
+        self.quote_snapshot_max_age = quote_snapshot_max_age
+        self.load_quote_snapshot()
+        self.quote_snapshot_task = PeriodicTask(self.save_quote_snapshot, quote_snapshot_period)
+        self.quote_snapshot_task.start()
+
+        # Quais ações existem, para não perguntar à fonte de cotações toda vez
+        self.ticker_cache = TickerCache(self.db, self.quote_provider.ticker_exists)
+        self.ticker_cache.load()
+
+        # Envia as cotações para os homebrokers inscritos, buscando cada ação uma vez só
+        self.quote_subscriptions = QuoteSubscriptions(self.get_quotes)
+        self.quote_push_task = PeriodicTask(self.quote_subscriptions.push, quote_push_period)
+
+        # No modo particionado cada ação tem um único worker que executa as ordens dela
+        self.matching_shards = (
+            MatchingShards(matching_shards, max_queue) if matching_shards is not None else None)
+
+        # Pool que executa as ordens novas (fora do modo particionado)
+        self.executor = BoundedExecutor(max_workers, max_queue)
+        # Pool só das trocas das varreduras, uma de compra e uma de venda.
+        # As varreduras seguram as travas dos clientes enquanto esperam um worker,
+        # e no pool das ordens novas todos os workers podiam estar esperando essas travas
+        self.sweep_executor = BoundedExecutor(len(OrderType), len(OrderType))
+
+        # Varredura das ordens ativas com o mercado real, começa depois de carregar as ordens
+        self.sweep_task = PeriodicTask(self.sweep_active_orders, sweep_period)
+
+        # Livro de ofertas com as ordens ativas, carregado depois da recuperação das transações
+        self.order_books = OrderBooks()
+        # Ordens fora do livro por estarem em transações que não terminaram a tempo: {id da transação: ordens}
+        self.unresolved_transactions: Dict[int, List[Tuple[OrderType, int]]] = {}
+        self.unresolved_lock = threading.Lock()
+
+        # Desativa as ordens quando elas expiram
+        self.expiry_scheduler = ExpiryScheduler(self.db, self.on_orders_expired)
 
         # Registra a aplicação no Pyro
         self.daemon = pyro.Daemon()
@@ -80,20 +190,22 @@ class StockMarket:
         nameserver._pyroClaimOwnership()
         # Carrega o Coordenador e os participantes pra cada cliente
         self.coordinator = Coordinator(self.db, self.daemon)
-        client_names = self.db.execute_with_fetch('select name from Client', True)
+        client_names = self.clients.get_names()
         orders = {}
         for client in client_names:
-            orders[client[0]] = self.get_client_orders_by_name(client[0], True)
+            orders[client] = self.get_client_orders_by_name(client, True)
         
         self.stock_locks: Dict[str, Dict[str, threading.Lock]] = {}
         self.participants = []
         for client_name in client_names:
-            self.stock_locks[client_name[0]] = {}
-            for order in orders[client_name[0]]:
-                if order.ticker not in self.stock_locks[client_name[0]]:
-                    self.stock_locks[client_name[0]][order.ticker] = threading.Lock()
-            if client_name[0] != 'Market':
-                self.participants.append(Participant(client_name[0], self.coordinator.uri, self.db, self.daemon))
+            self.stock_locks[client_name] = {}
+            for order in orders[client_name]:
+                if order.ticker not in self.stock_locks[client_name]:
+                    self.stock_locks[client_name][order.ticker] = self.new_stock_lock()
+            if client_name != 'Market':
+                self.participants.append(Participant(
+                    client_name, self.clients.get_id(client_name), self.coordinator.uri, self.db,
+                    self.daemon))
         
         self.market_participant = MarketParticipant(self.coordinator.uri, self.db, self.daemon)
         self.coordinator.add_participants({
@@ -108,6 +220,13 @@ class StockMarket:
         for participant in self.participants:
             participant.execute_initial_orders()
 
+        # Carrega as ordens ativas no livro de ofertas e agenda as expirações delas
+        self.load_order_books()
+        self.expiry_scheduler.load()
+        self.expiry_scheduler.start()
+        self.sweep_task.start()
+        self.quote_push_task.start()
+
         # Registra no nameserver
         nameserver.register('stockmarket', self.uri)
         nameserver._pyroRelease()
@@ -117,197 +236,327 @@ class StockMarket:
 
     def close(self):
         """Termina o aplicativo. Chamado após fechar a GUI e o Pyro."""
+        self.save_quote_snapshot()
         self.db.close()
 
-    def mark_expired_orders_as_inactive(self):
-        '''Marca as ordens ativas que já expiraram como inativas.'''
-        self.db.execute(
-            f"""update BuyOrder set active = 0 
-                where active = 1 and 
-                datetime(expiry_date)
-                    < datetime('{datetime.datetime.now().strftime(DATETIME_FORMAT)}')""")
-
-        self.db.execute(
-            f"""update SellOrder set active = 0 
-                where active = 1 and 
-                datetime(expiry_date)
-                    < datetime('{datetime.datetime.now().strftime(DATETIME_FORMAT)}')""")
+    def save_quote_snapshot(self):
+        """Salva as cotações do cache em um arquivo, para serem usadas quando o mercado reiniciar."""
+        snapshot = self.quote_cache.get_snapshot()
+        # Escreve em outro arquivo e troca, pra nunca deixar um snapshot pela metade
+        temp_path = self.quote_snapshot_path + '.tmp'
+        with open(temp_path, 'w') as fp:
+            json.dump(snapshot, fp)
+        os.replace(temp_path, self.quote_snapshot_path)
+
+    def load_quote_snapshot(self):
+        """Carrega o último snapshot das cotações, se existe."""
+        if not os.path.isfile(self.quote_snapshot_path):
+            return
+        try:
+            with open(self.quote_snapshot_path, 'r') as fp:
+                snapshot = json.load(fp)
+        except ValueError:
+            print(f"Ignoring invalid quote snapshot \"{self.quote_snapshot_path}\"")
+            return
+        loaded = self.quote_cache.load_snapshot(snapshot, self.quote_snapshot_max_age)
+        print(f"Loaded {loaded} of {len(snapshot)} quotes from the snapshot")
+
+    def new_stock_lock(self):
+        """
+        Cria a trava de uma ação de um cliente.
+        No modo particionado as ações já são serializadas pelos workers, então a trava não trava.
+        """
+        if self.matching_shards is not None:
+            return NullLock()
+        return threading.Lock()
+
+    def load_order_books(self):
+        """Carrega todas as ordens ativas do DB no livro de ofertas."""
+        for order_type in OrderType:
+            data = self.db.run_query(queries.SELECT_ACTIVE_CLIENT_ORDERS_WITH_CLIENT[order_type])
+            self.order_books.load(
+                self.book_order_from_entry(entry, order_type) for entry in data)
+
+    @staticmethod
+    def book_order_from_entry(entry: Sequence, order_type: OrderType) -> BookOrder:
+        """Cria uma ordem do livro a partir de uma linha `o.*, c.name` do DB."""
+        return BookOrder(
+            id_=entry[0],
+            type_=order_type,
+            client_id=entry[1],
+            client_name=entry[7],
+            ticker=entry[2],
+            amount=entry[3],
+            price=entry[4],
+            expiry_date=from_epoch_ms(entry[5])
+        )
+
+    def refresh_book_order(self, order_type: OrderType, order_id: int):
+        """
+        Atualiza uma ordem do livro de ofertas com o estado dela no DB.
+        Se a ordem não está mais ativa, tira ela do livro.
+        """
+        entry = self.db.run_query(queries.SELECT_ORDER_WITH_CLIENT[order_type], id=order_id)
+        if entry and entry[6]:
+            self.order_books.add(self.book_order_from_entry(entry, order_type))
+        else:
+            self.order_books.remove(order_type, order_id)
+            self.expiry_scheduler.unschedule(order_type, order_id)
+
+    def insert_order(self, order: Order, client_id: int) -> int:
+        """Insere uma ordem ativa no DB e agenda a expiração dela. Retorna o id dela."""
+        order_id = self.db.run_query(
+            queries.INSERT_ORDER[order.type],
+            ticker=order.ticker,
+            amount=order.amount,
+            price=order.price,
+            expiry_date=to_epoch_ms(order.expiry_date),
+            client_id=client_id,
+            active=1)
+        self.expiry_scheduler.schedule(order.type, order_id, order.expiry_date)
+        return order_id
+
+    def on_orders_expired(self, order_type: OrderType, order_ids: Sequence[int]):
+        '''Tira do livro de ofertas as ordens que o agendador de expiração desativou.'''
+        for order_id in order_ids:
+            self.order_books.remove(order_type, order_id)
     
-    def try_execute_active_orders(self, order_type: OrderType):
+    def sweep_active_orders(self):
+        '''
+        Tenta executar todas as ordens ativas com o mercado real.
+        Chamada periodicamente pela tarefa de varredura. Espera a varredura terminar.
+        '''
+        self.check_unresolved_transactions()
+        buy_sweep = self.try_execute_active_orders(OrderType.BUY)
+        sell_sweep = self.try_execute_active_orders(OrderType.SELL)
+        buy_sweep.result()
+        sell_sweep.result()
+
+    @pyro.expose
+    def trigger_sweep(self):
+        '''Pede uma varredura das ordens ativas com o mercado real agora, sem esperar o período.'''
+        self.sweep_task.trigger()
+
+    def try_execute_active_orders(self, order_type: OrderType) -> Future:
         '''
         Tenta executar todas as ordens ativas do tipo order_type.
         Como transações entre clientes internos sempre ocorrem no momento de criação das ordens,
         troca só com o mercado real.
+        Retorna um Future com o resultado da varredura (ver `try_trade_with_market`).
         '''
-
-        all_client_names = set(self.stock_locks.keys())
-        
-        # Verifica se tem alguma ordem expirada
-        # pra não executar uma transação que não deveria ocorrer
-        self.mark_expired_orders_as_inactive()
-
-        #Pega todas as travas de todas as ordens
-        stock_locks_already_locked = {}
-        for client_name in self.stock_locks.keys():
-            if client_name != 'Market':
-                for ticker in self.stock_locks[client_name].keys():
-                    result = self.stock_locks[client_name][ticker].acquire(blocking=False)
-                    if not result:
-                        if client_name not in stock_locks_already_locked:
-                            stock_locks_already_locked[client_name] = set()
-                        stock_locks_already_locked[client_name].add(ticker)
-
-        
-        active_orders = self.db.execute_with_fetch(
-            f''' select o.*, c.name 
-                    from {order_type.value} as o inner join Client as c on o.client_id = c.id
-                        where o.active = 1 ''', True)
-
-        active_order_copy = []
-        for data in active_orders:
-            if data[7] not in stock_locks_already_locked:
-                active_order_copy.append(data)
-            elif data[2] not in stock_locks_already_locked[data[7]]:
-                active_order_copy.append(data)
-
-        active_orders = active_order_copy
-
-        #Faz um dicionário de ordens ativas por cliente, subtrai os conjuntos para descobrir quem não tem ordem ativa
-        orders_by_client = {}
-
-        for data in active_orders:
-            if data[7] not in orders_by_client:
-                orders_by_client[data[7]] = set()    
-            orders_by_client[data[7]].add(data[2])
-
-        client_names_with_orders = set(orders_by_client.keys())
-
-        #Libera todas as travas dos clientes sem ordens ativas e sem trava
-        for client_name in (all_client_names.difference(client_names_with_orders)):
-            if client_name != 'Market' and client_name not in stock_locks_already_locked:
-                for ticker in self.stock_locks[client_name].keys():
-                    self.stock_locks[client_name][ticker].release()
-        
-        #Libera as travas das ações sem ordem ativa
-        for client_name in client_names_with_orders:
-            if client_name != 'Market':
-                for ticker in self.stock_locks[client_name].keys():
-                    if ticker not in orders_by_client[client_name]:
-                        #print("Linha 205, liberando a trava do ", client_name, ticker)
-                        self.stock_locks[client_name][ticker].release()
-
-        # Tenta executar
-        threading.Thread(target=self.try_trade_with_market,
-                         args=(order_type, active_orders),
-                         daemon=True).start()
+        # Pega as travas livres das ações dos clientes.
+        # As ações com a trava ocupada estão sendo executadas e ficam para a próxima varredura.
+        # As ordens do mercado nunca são varridas, então as travas dele não são pegas
+        locked = set()
+        for client_name, client_locks in list(self.stock_locks.items()):
+            if client_name == 'Market':
+                continue
+            for ticker, lock in list(client_locks.items()):
+                if lock.acquire(blocking=False):
+                    locked.add((client_name, ticker))
+
+        # Só varre as ordens das ações que conseguiu travar
+        active_orders = [
+            data for data in self.db.run_query(queries.SELECT_ACTIVE_ORDERS_WITH_CLIENT[order_type])
+            if (data[7], data[2]) in locked]
+
+        # Libera as travas das ações sem ordem ativa
+        locked_with_orders = {(data[7], data[2]) for data in active_orders}
+        for client_name, ticker in locked - locked_with_orders:
+            self.stock_locks[client_name][ticker].release()
+
+        # Tenta executar no pool das varreduras, que nunca espera as travas dos clientes
+        return self.sweep_executor.submit(
+            self.try_trade_with_market, order_type, active_orders, locked_with_orders)
     
     def try_trade_with_market(self,
                               order_type: OrderType,
-                              order_data: Sequence[Sequence]):
+                              order_data: Sequence[Sequence],
+                              locked: Iterable[Tuple[str, str]]) -> Tuple[int, int]:
         """
         Tenta transacionar um conjunto de ordens com o mercado real.
         Realiza as transações se o mercado está com um preço adequado.
+        Retorna quantas ordens foram avaliadas e quantas foram executadas.
 
         :param order_type: Tipo da ordem (compra ou venda).
         :param order_data: Conjunto de ordens para transacionar, no formato dado pelo sqlite.
+        :param locked: Travas (cliente, ação) das ordens, pegas pela varredura. São liberadas aqui.
         """
+        orders_by_ticker: Dict[str, List[Sequence]] = {}
         for order_entry in order_data:
-            ticker = order_entry[2]
-            real_price = self.get_quotes([ticker])[ticker]  # Pega o preço no mercado real
-            order_id = order_entry[0]
-            # Se a ação existe no mercado (tem um preço), tenta realizar
-            if real_price is not None:
-                order_price = order_entry[4]
-                client_id = order_entry[1]
-                order = Order(
-                    client_name='',  # Pro db não importa o nome do cliente
-                    type_=order_type,
-                    ticker=ticker,
-                    amount=order_entry[3],
-                    price=order_price,
-                    expiry_date=datetime.datetime.strptime(order_entry[5], DATETIME_FORMAT),
-                    active=True
-                )
-                # Se tiver um preço adequado, executa a transação
-                if ((order_type == OrderType.BUY) and (real_price < order_price)
-                        or ((order_type == OrderType.SELL) and (real_price > order_price))):
-                    if ticker not in self.stock_locks['Market']:
-                        self.stock_locks['Market'][ticker] = threading.Lock()
-                    with self.stock_locks['Market'][ticker]:
-                        self.trade_with_market(order, client_id, real_price, order_id)
-                
-                #Libera a trava dessa ação
-                self.stock_locks[order_entry[7]][ticker].release()
-            
-            # Se a ação não existe mais no mercado, marca como inativa
-            else:
-                self.db.execute(
-                    f''' update {order_type.value} set active = 0 
-                        where id = {order_id}''')
-                self.stock_locks[order_entry[7]][ticker].release()
+            orders_by_ticker.setdefault(order_entry[2], []).append(order_entry)
+        locked_clients: Dict[str, Set[str]] = {}
+        for client_name, ticker in locked:
+            locked_clients.setdefault(ticker, set()).add(client_name)
+
+        # Pega o preço no mercado real de todas as ações de uma vez,
+        # e avalia todas as ordens com essas cotações
+        try:
+            quotes = self.get_quotes(list(orders_by_ticker.keys()))
+        except Exception:
+            for client_name, ticker in locked:
+                self.stock_locks[client_name][ticker].release()
+            raise
+
+        # No modo particionado, cada ação é executada pelo worker dela
+        if self.matching_shards is not None:
+            futures = [
+                self.matching_shards.submit(
+                    ticker, self.trade_orders_with_market, order_type, ticker, entries, quotes,
+                    locked_clients.get(ticker, set()))
+                for ticker, entries in orders_by_ticker.items()]
+            results = [future.result() for future in futures]
+        else:
+            results = [
+                self.trade_orders_with_market(
+                    order_type, ticker, entries, quotes, locked_clients.get(ticker, set()))
+                for ticker, entries in orders_by_ticker.items()]
+
+        evaluated = sum(result[0] for result in results)
+        filled = sum(result[1] for result in results)
+        print(f"Market sweep ({order_type.value}): {evaluated} orders evaluated, {filled} filled")
+        return evaluated, filled
+
+    def trade_orders_with_market(self,
+                                 order_type: OrderType,
+                                 ticker: str,
+                                 order_data: Sequence[Sequence],
+                                 quotes: Mapping[str, Optional[float]],
+                                 locked_clients: Iterable[str]) -> Tuple[int, int]:
+        """
+        Tenta transacionar as ordens de uma ação com o mercado real, usando cotações já obtidas.
+        Retorna quantas ordens foram avaliadas e quantas foram executadas.
+
+        :param order_type: Tipo da ordem (compra ou venda).
+        :param ticker: Ação das ordens.
+        :param order_data: Conjunto de ordens para transacionar, no formato dado pelo sqlite.
+        :param quotes: Cotação de cada ação das ordens.
+        :param locked_clients: Clientes com a trava da ação pega pela varredura.
+            As travas são liberadas depois de avaliar todas as ordens.
+        """
+        evaluated = 0
+        filled = 0
+        real_price = quotes[ticker]
+        try:
+            for order_entry in order_data:
+                order_id = order_entry[0]
+                # Se a ordem foi executada ou desativada depois de ser lida do DB, ignora
+                book_order = self.order_books.get(order_type, order_id)
+                if book_order is None:
+                    continue
+                evaluated += 1
+                # Se a ação existe no mercado (tem um preço), tenta realizar
+                if real_price is not None:
+                    order_price = book_order.price
+                    client_id = order_entry[1]
+                    order = Order(
+                        client_name='',  # Pro db não importa o nome do cliente
+                        type_=order_type,
+                        ticker=ticker,
+                        amount=book_order.amount,
+                        price=order_price,
+                        expiry_date=from_epoch_ms(order_entry[5]),
+                        active=True
+                    )
+                    # Se tiver um preço adequado, executa a transação
+                    if ((order_type == OrderType.BUY) and (real_price < order_price)
+                            or ((order_type == OrderType.SELL) and (real_price > order_price))):
+                        if ticker not in self.stock_locks['Market']:
+                            self.stock_locks['Market'][ticker] = self.new_stock_lock()
+                        with self.stock_locks['Market'][ticker]:
+                            self.trade_with_market(order, client_id, real_price, order_id)
+                        filled += 1
+
+                # Se a ação não existe mais no mercado, marca como inativa
+                else:
+                    self.db.run_query(queries.DEACTIVATE_ORDER[order_type], id=order_id)
+                    self.order_books.remove(order_type, order_id)
+                    self.expiry_scheduler.unschedule(order_type, order_id)
+        finally:
+            # Libera as travas dessa ação
+            for client_name in locked_clients:
+                self.stock_locks[client_name][ticker].release()
+
+        return evaluated, filled
+
     def trade_with_internal_clients(self,
                                     order: Order,
                                     client_id: int,
-                                    matching_data: Sequence[Sequence]):
+                                    matching_orders: Sequence[BookOrder],
+                                    locked_clients: Sequence[str]) -> Tuple[float, int, bool]:
         '''
         Executa uma ordem de um cliente, trocando com clientes internos.
 
         Sempre realiza a transação, então deve ser chamada apenas depois de verificar
         se as transações vão ser válidas.
+        Retorna a quantidade que sobrou da ordem, o id dela no DB e se todas as transações terminaram.
+        Se uma transação não termina a tempo, não faz as próximas.
+        Transações abortadas não contam na quantidade executada.
 
         :param order: A ordem que vai realizar.
         :param client_id: Id no DB do cliente que criou a ordem.
-        :param matching_data: Ordens com as quais vai realizar as transações.
+        :param matching_orders: Ordens com as quais vai realizar as transações,
+            em ordem de prioridade.
+        :param locked_clients: Clientes com a trava da ação pega por quem chamou. As travas são liberadas aqui.
         '''
 
         # Coloca a ordem que quer realizar no DB
-        order_id = self.db.execute(
-            f'''insert into {order.type.value} (ticker, amount, price, expiry_date, client_id, active)
-                values (
-                    '{order.ticker}', {order.amount}, {order.price}, '{order.expiry_date}', 
-                    {client_id}, 1
-                )''')
+        order_id = self.insert_order(order, client_id)
 
         # Pega a quantidade de ações para serem transacionadas
         amount = 0
         matching_ids = []  # Ids dos clientes com quem pode transacionar
         matching_names = {} #Nome dos clientes com quem pode transacionar
         order_amount = order.amount
-        for matching_order in matching_data:
-            amount += matching_order[3]
-            matching_ids.append(matching_order[0])
-            matching_names[matching_order[0]] = matching_order[7]
+        for matching_order in matching_orders:
+            amount += matching_order.amount
+            matching_ids.append(matching_order.id)
+            matching_names[matching_order.id] = matching_order.client_name
             if (amount >= order_amount):
                 break
         
         #Libera a trava dos clientes que não vão fazer transação
-        for client_name in self.stock_locks.keys():
-            if order.ticker in self.stock_locks[client_name].keys():
-                if client_name not in matching_names.values() and client_name != order.client_name:
-                    self.stock_locks[client_name][order.ticker].release()
+        for client_name in locked_clients:
+            if client_name not in matching_names.values():
+                self.stock_locks[client_name][order.ticker].release()
 
         # Executa transações com os clientes dados
+        finished = True
         for i, matching_id in enumerate(matching_ids):
             # Calcula quantidade e preço da transação
 
-            transaction_amount = min(matching_data[i][3], order_amount)
-            price = matching_data[i][4]
+            transaction_amount = min(matching_orders[i].amount, order_amount)
+            price = matching_orders[i].price
             if order.type == OrderType.BUY:
                 buy_order_id = order_id
                 sell_order_id = matching_id
             else:
                 sell_order_id = order_id
                 buy_order_id = matching_id
-            tid = self.coordinator.open_transaction(buy_order_id, sell_order_id, transaction_amount, price)
+            handle = self.coordinator.open_transaction(buy_order_id, sell_order_id, transaction_amount, price)
+            if not self.wait_transaction(
+                    handle, [(order.type, order_id), (order.type.get_matching(), matching_id)]):
+                finished = False
+                break
+
+            # Se a transação foi abortada, a outra ordem não consegue ser executada,
+            # então sai do livro para não ser escolhida de novo, e tenta a próxima.
+            # Ela continua ativa no DB até expirar
+            if handle.state != TransactionState.COMPLETED:
+                print(f"Transaction {handle.id} was aborted")
+                self.order_books.remove(order.type.get_matching(), matching_id)
+                continue
 
-            while(not self.coordinator.is_transaction_finished(tid)):
-                time.sleep(0.01)
-            
-            #Libera a trava do cliente que transacionou
-            self.stock_locks[matching_names[matching_id]][order.ticker].release()
+            # Atualiza o livro com o que sobrou da ordem com quem transacionou
+            self.refresh_book_order(order.type.get_matching(), matching_id)
             order_amount -= transaction_amount
 
-        return order_amount, order_id
+        #Libera a trava dos clientes que transacionaram
+        for client_name in locked_clients:
+            if client_name in matching_names.values():
+                self.stock_locks[client_name][order.ticker].release()
+
+        return order_amount, order_id, finished
 
     def trade_with_market(self,
                           order: Order,
@@ -327,35 +576,21 @@ class StockMarket:
         # Se a ordem não existe no DB, cria uma nova com os valroes de `order`
 
         if order_id is None:
-            command = (
-                f'''insert into {order.type.value}
-                    (ticker, amount, price, expiry_date, client_id, active)
-                    values (
-                        '{order.ticker}',
-                        {order.amount},
-                        {order.price},
-                        '{order.expiry_date}',
-                        {client_id},
-                        1
-                    )''')
-            own_order_id = self.db.execute(command)
+            own_order_id = self.insert_order(order, client_id)
         else:
             own_order_id = order_id
 
         matching_type = order.type.get_matching()
-        # Cria a ordem correspondente no nome do mercado, com qual vai fazer a transação
-        command = (
-            f'''insert into {matching_type.value}
-            (ticker, amount, price, expiry_date, client_id, active)
-            values (
-                '{order.ticker}',
-                {order.amount},
-                {real_price},
-                '{order.expiry_date}',
-                (select id from Client where name = 'Market'),
-                1
-            )''')
-        new_matching_id = self.db.execute(command)
+        # Cria a ordem correspondente no nome do mercado, com qual vai fazer a transação.
+        # Ela expira junto com a ordem do cliente, se a transação não terminar
+        matching_order = Order(
+            client_name='Market',
+            type_=matching_type,
+            ticker=order.ticker,
+            amount=order.amount,
+            price=real_price,
+            expiry_date=order.expiry_date)
+        new_matching_id = self.insert_order(matching_order, self.clients.get_id('Market'))
 
         if order.type == OrderType.BUY:
                 buy_order_id = own_order_id
@@ -364,9 +599,49 @@ class StockMarket:
             sell_order_id = own_order_id
             buy_order_id = new_matching_id
 
-        tid = self.coordinator.open_transaction(buy_order_id, sell_order_id, order.amount, real_price)
-        while(not self.coordinator.is_transaction_finished(tid)):
-                time.sleep(0.01)
+        handle = self.coordinator.open_transaction(buy_order_id, sell_order_id, order.amount, real_price)
+        if not self.wait_transaction(handle, [(order.type, own_order_id)]):
+            return
+        # A ordem do mercado é executada inteira, então não precisa mais expirar
+        if handle.state == TransactionState.COMPLETED:
+            self.expiry_scheduler.unschedule(matching_type, new_matching_id)
+
+        # A ordem foi executada inteira, então sai do livro
+        self.refresh_book_order(order.type, own_order_id)
+
+    def wait_transaction(self,
+                         handle: TransactionHandle,
+                         orders: Sequence[Tuple[OrderType, int]]) -> bool:
+        '''
+        Espera uma transação terminar. Retorna se ela terminou a tempo.
+        Se não terminou, as ordens dela saem do livro de ofertas até o resultado ser conhecido,
+        para não serem executadas de novo enquanto a transação ainda pode acontecer.
+        A varredura devolve elas ao livro quando a transação termina (ver `check_unresolved_transactions`).
+
+        :param handle: Transação aberta no coordenador.
+        :param orders: Tipo e id das ordens da transação que podem estar no livro.
+        '''
+        if handle.wait():
+            return True
+        print(f"Transaction {handle.id} didn't finish in time")
+        self.coordinator.forget_transaction_handle(handle.id)
+        with self.unresolved_lock:
+            self.unresolved_transactions[handle.id] = list(orders)
+        for order_type, order_id in orders:
+            self.order_books.remove(order_type, order_id)
+        return False
+
+    def check_unresolved_transactions(self):
+        '''Devolve ao livro de ofertas as ordens das transações que não terminaram a tempo e já terminaram.'''
+        with self.unresolved_lock:
+            unresolved = list(self.unresolved_transactions.items())
+        for transaction_id, orders in unresolved:
+            if self.coordinator.get_transaction_outcome(transaction_id) is None:
+                continue
+            with self.unresolved_lock:
+                del self.unresolved_transactions[transaction_id]
+            for order_type, order_id in orders:
+                self.refresh_book_order(order_type, order_id)
 
     def client_has_stock(self,
                          client_id: int,
@@ -377,12 +652,7 @@ class StockMarket:
         Se `amount` foi dado, verifica se tem pelo menos a quantidade dada.
         """
         # Pega os dados do DB
-        data = self.db.execute_with_fetch(
-            f'''select os.* from Client as c 
-                inner join OwnedStock as os on c.id = os.client_id 
-                    where os.ticker = '{ticker}' and 
-                    c.id = {client_id} ''', False
-        )
+        data = self.db.run_query(queries.SELECT_OWNED_STOCK, client_id=client_id, ticker=ticker)
 
         # Se não tem a ação
         if not data:
@@ -404,16 +674,7 @@ class StockMarket:
         Retorna um dicionario com os ids de cada nome dado.
         Se o nome não existe, tem valor None.
         """
-        data = self.db.execute_with_fetch(
-            f'''select id, name from Client 
-                where name in {f"('{client_names[0]}')" if (len(client_names) == 1) else tuple(client_names)} ''', True
-        )
-
-        id_map = {name: None for name in client_names}
-        for entry in data:
-            if entry[1] in id_map:
-                id_map[entry[1]] = entry[0]
-        return id_map
+        return self.clients.get_ids(client_names)
 
     def get_client_orders_by_name(self,
                                   client_name: str,
@@ -425,14 +686,13 @@ class StockMarket:
         :param active_only: Se retorna só as ordens ativas, ou se retorna todas.
         """
         orders = []
-        buy_data = self.db.execute_with_fetch(
-            f'''select * from BuyOrder
-                where 
-                    client_id = (
-                        select id from Client where name = '{client_name}'
-                    )
-                    {'and active = 1' if active_only else ""} ''', True
-        )
+        client_id = self.clients.get_id(client_name)
+        if client_id is None:
+            return orders
+
+        buy_data = self.db.run_query(
+            queries.SELECT_CLIENT_ORDERS[OrderType.BUY],
+            client_id=client_id, active_only=active_only)
         for order in buy_data:
             orders.append(Order(
                     client_name=client_name,
@@ -440,18 +700,14 @@ class StockMarket:
                     ticker=order[2],
                     amount=order[3],
                     price=order[4],
-                    expiry_date=datetime.datetime.strptime(order[5], DATETIME_FORMAT),
-                    active=bool(order[6])
+                    expiry_date=from_epoch_ms(order[5]),
+                    active=bool(order[6]),
+                    id_=order[0]
             ))
 
-        sell_data = self.db.execute_with_fetch(
-            f'''select * from SellOrder
-                where 
-                    client_id = (
-                        select id from Client where name = '{client_name}'
-                    )
-                    {'and active = 1' if active_only else ""} ''', True
-        )
+        sell_data = self.db.run_query(
+            queries.SELECT_CLIENT_ORDERS[OrderType.SELL],
+            client_id=client_id, active_only=active_only)
         for order in sell_data:
             orders.append(Order(
                     client_name=client_name,
@@ -459,8 +715,9 @@ class StockMarket:
                     ticker=order[2],
                     amount=order[3],
                     price=order[4],
-                    expiry_date=datetime.datetime.strptime(order[5], DATETIME_FORMAT),
-                    active=bool(order[6])
+                    expiry_date=from_epoch_ms(order[5]),
+                    active=bool(order[6]),
+                    id_=order[0]
             ))
 
         return orders
@@ -470,17 +727,16 @@ class StockMarket:
         '''Insere um novo cliente no sistema.'''
 
         # Verifica se cliente já existe
-        client_id = self.get_client_ids_by_names((client_name,))[client_name]
-        if client_id is not None:
+        if self.clients.get_id(client_name) is not None:
             return MarketErrorCode.CLIENT_ALREADY_EXISTS
         
         # Adiciona cliente no DB
-        self.db.execute(f"insert into Client(name) values ('{client_name}')")
+        client_id = self.clients.add(client_name)
 
         # Cria um novo participante e manda pro coordenador
         if (client_name != 'Market'):
             new_participant = Participant(
-                client_name, self.coordinator.uri, self.db, self.daemon)
+                client_name, client_id, self.coordinator.uri, self.db, self.daemon)
             self.participants.append(new_participant)
             self.coordinator.add_participants({new_participant.name: new_participant.uri})
             new_participant.get_initial_state()
@@ -492,51 +748,125 @@ class StockMarket:
 
     @pyro.expose
     def check_ticker_exists(self, ticker: str) -> bool:
-        """retorna se uma ação existe na api."""
-        
-        with self.yahoo_lock:
-            data = yf.download(ticker, period="1d")
-            return len(data) > 0
+        """retorna se uma ação existe na fonte de cotações."""
+        return self.ticker_cache.exists(ticker)
 
     @pyro.expose
     def create_order(self, order: Order) -> MarketErrorCode:
         '''Cria ordem de compra ou venda e, se possível, realiza transações com ela.'''
+        return self.create_orders([order])[0]
+
+    @pyro.expose
+    def create_orders(self, orders: Sequence[Order]) -> List[MarketErrorCode]:
+        '''
+        Cria um conjunto de ordens de compra ou venda e, se possível, realiza transações com elas.
+        Valida os clientes com uma consulta só e pega as cotações de todas as ações de uma vez.
+        Retorna o código de erro de cada ordem, na mesma ordem em que foram dadas.
+        '''
+        if not orders:
+            return []
+
+        # Verifica se os clientes existem
+        client_ids = self.get_client_ids_by_names(
+            list({order.client_name for order in orders}))
+
+        # Pega o valor do mercado das ações das ordens que ainda podem ser válidas
+        now = datetime.datetime.now()
+        tickers = list({
+            order.ticker for order in orders
+            if now < order.expiry_date and client_ids[order.client_name] is not None})
+        # Se as cotações não chegam a tempo, recusa as ordens em vez de travar o pedido
+        try:
+            quotes = self.get_quotes(tickers)
+        except QuoteFetchError as e:
+            print(e)
+            return [MarketErrorCode.BUSY] * len(orders)
+
+        # Cada ordem é validada e executada em um worker, então as ordens do conjunto
+        # não esperam umas pelas outras na thread do pedido
+        results = [
+            self.submit_order(order, client_ids[order.client_name], quotes.get(order.ticker))
+            for order in orders]
+        return [result.result() for result in results]
+
+    def submit_order(self,
+                     order: Order,
+                     client_id: Optional[int],
+                     real_price: Optional[float]) -> 'Future[MarketErrorCode]':
+        '''
+        Valida uma ordem nova e manda ela para ser executada.
+        Retorna um Future com o código de erro da ordem, que fica pronto
+        quando a ordem é aceita ou recusada, sem esperar ela ser executada.
+
+        :param order: Ordem que vai ser criada.
+        :param client_id: Id no DB do cliente que criou a ordem, ou None se o cliente não existe.
+        :param real_price: Preço da ação no mercado real, ou None se a ação não existe.
+        '''
+        result = Future()
+
         # Verifica se a ordem expirou
         if (datetime.datetime.now() >= order.expiry_date):
             print("Order is expired")
-            return MarketErrorCode.EXPIRED_ORDER
+            result.set_result(MarketErrorCode.EXPIRED_ORDER)
+            return result
 
         # Verifica se o cliente existe
-        client_id = self.get_client_ids_by_names((order.client_name,))[order.client_name]
         if client_id is None:
             print("Client not found")
-            return MarketErrorCode.UNKNOWN_CLIENT
+            result.set_result(MarketErrorCode.UNKNOWN_CLIENT)
+            return result
 
-        # Atualiza o estado de expiração das ordens
-        self.mark_expired_orders_as_inactive()
+        # Verifica se a ação existe no mercado
+        if real_price is None:
+            print("Ticker not found in the market")
+            result.set_result(MarketErrorCode.UNKNOWN_TICKER)
+            return result
 
         if not order.ticker in self.stock_locks[order.client_name].keys():
-            self.stock_locks[order.client_name][order.ticker] = threading.Lock()
+            self.stock_locks[order.client_name][order.ticker] = self.new_stock_lock()
 
+        try:
+            if self.matching_shards is not None:
+                self.matching_shards.submit(
+                    order.ticker, self.accept_new_order, client_id, order, real_price, result,
+                    block=False)
+            else:
+                self.executor.submit(
+                    self.accept_new_order, client_id, order, real_price, result, block=False)
+        # Se tem ordens demais esperando, recusa a ordem
+        except queue.Full:
+            print("Too many orders waiting to be executed")
+            result.set_result(MarketErrorCode.BUSY)
+
+        return result
+
+    def accept_new_order(self,
+                         client_id: int,
+                         order: Order,
+                         real_price: float,
+                         result: 'Future[MarketErrorCode]'):
+        '''
+        Pega a trava do cliente na ação, confere se ele tem as ações que quer vender e executa a ordem.
+        Roda em um worker. O código de erro vai para `result` antes da ordem ser executada.
+        '''
         #Pega a trava para a ordem desse cliente
         self.stock_locks[order.client_name][order.ticker].acquire()
-        # Se quer vender, checa se tem ações o suficiente
-        if order.type == OrderType.SELL:
-            if not self.client_has_stock(client_id, order.ticker, amount=order.amount):
+        try:
+            # Se quer vender, checa se tem ações o suficiente
+            if (order.type == OrderType.SELL
+                    and not self.client_has_stock(client_id, order.ticker, amount=order.amount)):
                 print("Client doesn't have enough stock to sell")
-                return MarketErrorCode.NOT_ENOUGH_STOCK
-
-        # Pega o valor do mercado
-        real_price = self.get_quotes([order.ticker])[order.ticker]
-        if real_price is None:
-            print("Ticker not found in the market")
-            return MarketErrorCode.UNKNOWN_TICKER
-
-        threading.Thread(target=self.try_execute_new_order,
-                         args=(client_id, order, real_price),
-                         daemon=True).start()
-
-        return MarketErrorCode.SUCCESS
+                self.stock_locks[order.client_name][order.ticker].release()
+                result.set_result(MarketErrorCode.NOT_ENOUGH_STOCK)
+                return
+        except Exception as e:
+            self.stock_locks[order.client_name][order.ticker].release()
+            result.set_exception(e)
+            raise
+        result.set_result(MarketErrorCode.SUCCESS)
+
+        # try_execute_new_order libera a trava do cliente
+        self.try_execute_new_order(client_id, order, real_price)
 
     def try_execute_new_order(self, client_id: int, order: Order, real_price: float):
 
@@ -546,85 +876,265 @@ class StockMarket:
         target_price = max(order.price, real_price)
 
         # Pega a trava de todas os clientes que possuem a ação
-        for client_name in self.stock_locks.keys():
-            if order.ticker in self.stock_locks[client_name].keys() and client_name != order.client_name and client_name != 'Market':
-                self.stock_locks[client_name][order.ticker].acquire()
+        locked_clients = [
+            client_name for client_name, client_locks in list(self.stock_locks.items())
+            if order.ticker in client_locks and client_name != order.client_name and client_name != 'Market']
+        for client_name in locked_clients:
+            self.stock_locks[client_name][order.ticker].acquire()
         
-        # Pega as ordens que conseguem realizar a ordem sendo criada
-        matching_type = order.type.get_matching()
-        command = (
-            f'''select o.*, c.name 
-                from {matching_type.value} as o inner join Client as c on o.client_id = c.id
-                    where o.ticker = '{order.ticker}' 
-                        and o.price {'>=' if order.type == OrderType.SELL else '<='} {target_price} 
-                        and o.active = 1
-                order by o.price {'desc' if order.type == OrderType.SELL else 'asc'}''')
-        matching_data = self.db.execute_with_fetch(command, True)
-
+        # Pega no livro de ofertas as ordens que conseguem realizar a ordem sendo criada
+        matching_orders = self.order_books.get_matching(
+            order.type, order.ticker, target_price, order.amount)
 
         # Se os clientes internos tem um preço melhor que o do mercado transaciona o máximo possível
         order_id = None
-        if len(matching_data) > 0:
+        finished = True
+        if len(matching_orders) > 0:
             print("Doing transaction with internal client")
-            order.amount, order_id = self.trade_with_internal_clients(
-                order, client_id, matching_data)
+            order.amount, order_id, finished = self.trade_with_internal_clients(
+                order, client_id, matching_orders, locked_clients)
         else:
             # Libera a trava de todas os clientes que possuem a ação
-            for client_name in self.stock_locks.keys():
-                if order.ticker in self.stock_locks[client_name].keys() and client_name != order.client_name and client_name != 'Market':
-                    self.stock_locks[client_name][order.ticker].release()
+            for client_name in locked_clients:
+                self.stock_locks[client_name][order.ticker].release()
+        # Se uma transação não terminou a tempo, o que sobrou da ordem
+        # volta ao livro quando ela terminar, sem trocar com o mercado
+        if not finished:
+            print("Leaving the rest of the order until the transaction finishes")
         # Se sobrou ações na ordem
-        if order.amount > 0:
+        elif order.amount > 0:
             # Troca com o mercado caso tenha um preço que realize a ordem
             if ((order.type == OrderType.SELL and order.price <= real_price)
                     or (order.type == OrderType.BUY and order.price > real_price)):
                 print("Doing transaction with market")
                 if order.ticker not in self.stock_locks['Market']:
-                    self.stock_locks['Market'][order.ticker] = threading.Lock()
+                    self.stock_locks['Market'][order.ticker] = self.new_stock_lock()
                 with self.stock_locks['Market'][order.ticker]:
                     self.trade_with_market(order, client_id, real_price, order_id)
-            # Caso contrario, guarda o que sobrou da ordem no DB
+            # Caso contrario, guarda o que sobrou da ordem no DB e no livro de ofertas
+            # Se já transacionou com clientes internos, o que sobrou já está na ordem do DB
             else:
                 print("Creating order")
-                self.db.execute(
-                    f'''insert into {order.type.value}
-                        (ticker, amount, price, expiry_date, client_id, active) 
-                        values (
-                            '{order.ticker}',
-                            {order.amount},
-                            {order.price},
-                            '{order.expiry_date}', 
-                            {client_id},
-                            1)''')
+                if order_id is None:
+                    order_id = self.insert_order(order, client_id)
+                self.refresh_book_order(order.type, order_id)
+        # Se foi executada inteira com clientes internos, a ordem já foi desativada
+        elif order_id is not None:
+            self.refresh_book_order(order.type, order_id)
 
         #Libera a trava do cliente principal
         self.stock_locks[order.client_name][order.ticker].release()
         
+    def run_exclusively(self, client_name: str, ticker: str, function: Callable, *args: Any) -> Any:
+        """
+        Executa uma função sem que as ordens de um cliente em uma ação sejam executadas ao mesmo tempo.
+        No modo particionado, executa no worker da ação. Se não, segura a trava do cliente na ação.
+        Retorna o resultado da função.
+        """
+        if self.matching_shards is not None:
+            return self.matching_shards.submit(ticker, function, *args).result()
+
+        if ticker not in self.stock_locks[client_name]:
+            self.stock_locks[client_name][ticker] = self.new_stock_lock()
+        with self.stock_locks[client_name][ticker]:
+            return function(*args)
+
+    def get_client_book_order(self,
+                              client_name: str,
+                              order_type: OrderType,
+                              order_id: int) -> Optional[BookOrder]:
+        """Retorna uma ordem ativa do livro, ou None se ela não existe ou é de outro cliente."""
+        book_order = self.order_books.get(order_type, order_id)
+        if book_order is None or book_order.client_name != client_name:
+            return None
+        return book_order
+
+    @pyro.expose
+    def cancel_order(self, client_name: str, order_type: str, order_id: int) -> MarketErrorCode:
+        """
+        Cancela uma ordem ativa de um cliente.
+
+        :param client_name: Nome do cliente que criou a ordem.
+        :param order_type: Tipo da ordem (valor de `OrderType`).
+        :param order_id: Id da ordem.
+        """
+        order_type = OrderType(order_type)
+        book_order = self.get_client_book_order(client_name, order_type, order_id)
+        if book_order is None:
+            print("Order not found")
+            return MarketErrorCode.UNKNOWN_ORDER
+
+        return self.run_exclusively(
+            client_name, book_order.ticker,
+            self.try_cancel_order, client_name, order_type, order_id)
+
+    def try_cancel_order(self,
+                         client_name: str,
+                         order_type: OrderType,
+                         order_id: int) -> MarketErrorCode:
+        """Cancela uma ordem. Deve ser chamada com a ação da ordem travada."""
+        # A ordem pode ter sido executada enquanto esperava a trava
+        if self.get_client_book_order(client_name, order_type, order_id) is None:
+            return MarketErrorCode.UNKNOWN_ORDER
+
+        self.db.run_query(queries.DEACTIVATE_ORDER[order_type], id=order_id)
+        self.order_books.remove(order_type, order_id)
+        self.expiry_scheduler.unschedule(order_type, order_id)
+        print(f"Cancelled order {order_id} of {client_name}")
+        return MarketErrorCode.SUCCESS
+
+    @pyro.expose
+    def amend_order(self,
+                    client_name: str,
+                    order_type: str,
+                    order_id: int,
+                    amount: float,
+                    price: float) -> MarketErrorCode:
+        """
+        Altera a quantidade e o preço de uma ordem ativa de um cliente.
+        Se só diminuir a quantidade, a ordem mantém a prioridade na fila do preço.
+        Se não, vai para o fim da fila.
+
+        :param client_name: Nome do cliente que criou a ordem.
+        :param order_type: Tipo da ordem (valor de `OrderType`).
+        :param order_id: Id da ordem.
+        :param amount: Nova quantidade de ações que ainda falta transacionar.
+        :param price: Novo preço da ordem.
+        """
+        order_type = OrderType(order_type)
+        if amount <= 0 or price <= 0:
+            print("Invalid amount or price")
+            return MarketErrorCode.INVALID_ORDER
+
+        book_order = self.get_client_book_order(client_name, order_type, order_id)
+        if book_order is None:
+            print("Order not found")
+            return MarketErrorCode.UNKNOWN_ORDER
+
+        return self.run_exclusively(
+            client_name, book_order.ticker,
+            self.try_amend_order, client_name, order_type, order_id, amount, price)
+
+    def try_amend_order(self,
+                        client_name: str,
+                        order_type: OrderType,
+                        order_id: int,
+                        amount: float,
+                        price: float) -> MarketErrorCode:
+        """Altera uma ordem. Deve ser chamada com a ação da ordem travada."""
+        # A ordem pode ter sido executada enquanto esperava a trava
+        book_order = self.get_client_book_order(client_name, order_type, order_id)
+        if book_order is None:
+            return MarketErrorCode.UNKNOWN_ORDER
+
+        # Se vai vender mais, checa se tem ações o suficiente
+        if (order_type == OrderType.SELL and amount > book_order.amount
+                and not self.client_has_stock(book_order.client_id, book_order.ticker, amount)):
+            print("Client doesn't have enough stock to sell")
+            return MarketErrorCode.NOT_ENOUGH_STOCK
+
+        self.db.run_query(
+            queries.UPDATE_ORDER_AMOUNT_AND_PRICE[order_type], id=order_id, amount=amount, price=price)
+
+        amended_order = BookOrder(
+            id_=order_id,
+            type_=order_type,
+            client_id=book_order.client_id,
+            client_name=client_name,
+            ticker=book_order.ticker,
+            amount=amount,
+            price=price,
+            expiry_date=book_order.expiry_date
+        )
+        # Só mantém a prioridade se o preço é o mesmo e a quantidade não aumentou
+        if price != book_order.price or amount > book_order.amount:
+            self.order_books.remove(order_type, order_id)
+        self.order_books.add(amended_order)
+        print(f"Amended order {order_id} of {client_name}")
+        return MarketErrorCode.SUCCESS
+
+    @pyro.expose
+    def get_execution_stats(self) -> Dict[str, Any]:
+        """
+        Retorna o tamanho das filas e a latência das tarefas do pool e dos workers,
+        e quantas escritas no banco de dados foram feitas por commit.
+        """
+        return {
+            'executor': self.executor.get_stats(),
+            'sweep_executor': self.sweep_executor.get_stats(),
+            'shards': (
+                self.matching_shards.get_stats() if self.matching_shards is not None else []),
+            'db': self.db.get_write_stats()
+        }
+
     @pyro.expose
     def get_quotes(self, tickers: Sequence[str]) -> Dict[str, Optional[float]]:
-        """Retorna a cotação atual de um conjunto de ações."""
+        """
+        Retorna a cotação atual de um conjunto de ações.
+        Usa o cache, só buscando no mercado as cotações que não estão nele ou que venceram.
+        """
+        return self.quote_cache.get_quotes(tickers)
+
+    @pyro.expose
+    def subscribe_quotes(self, tickers: Sequence[str], callback_uri: str):
+        """
+        Inscreve um homebroker nas cotações de um conjunto de ações.
+        As cotações que mudarem são enviadas para o método oneway `push_quotes` do homebroker.
+
+        :param tickers: Ações que o homebroker quer receber.
+        :param callback_uri: Uri do homebroker no Pyro.
+        """
+        self.quote_subscriptions.subscribe(tickers, callback_uri)
+        # Envia logo as cotações atuais das ações novas
+        self.quote_push_task.trigger()
+
+    @pyro.expose
+    def unsubscribe_quotes(self, tickers: Optional[Sequence[str]], callback_uri: str):
+        """
+        Cancela a inscrição de um homebroker nas cotações de um conjunto de ações.
+        Se `tickers` for None, cancela todas as inscrições do homebroker.
+        """
+        self.quote_subscriptions.unsubscribe(tickers, callback_uri)
+
+    @pyro.expose
+    def get_quote_stats(self) -> Dict[str, Any]:
+        """Retorna os contadores do cache de cotações e o histograma do tamanho das buscas."""
+        return self.quote_cache.get_stats()
+
+    def fetch_quotes(self, tickers: Sequence[str]) -> Dict[str, Optional[float]]:
+        """Busca na fonte de cotações a cotação atual de um conjunto de ações."""
         # A cotação atual é sempre a do mercado
         # Os clientes internos tem ordem de compra ativa maior que o preço do mercado
         # Porque eles já teriam vendido para o mercado
-
-        # Dependendo do numero de ações para pegar cotação faz algo diferente
-        # por causa da estrutura de dados que o yfinance usa
-        
-        print(f"get_quotes: {len(tickers)} tickers - {tickers}")
+        print(f"fetch_quotes: {len(tickers)} tickers - {tickers}")
         if len(tickers) == 0:
             return {}
-        with self.yahoo_lock:
-            data = yf.download(tickers, period="1d", progress=False)["Adj Close"]
-        if len(tickers) == 1:
-            quotes = {tickers[0]: round(float(data.values[0]), 2) if len(data.values) > 0 else None}
-        else:
-            quotes: Dict[str, Optional[float]] = {ticker: None for ticker in tickers}
-            for ticker in quotes:
-                quote = data.loc[:, ticker.upper()].values[0]
-                if not math.isnan(quote):
-                    quotes[ticker] = round(float(quote), 2)
+        quotes = self.quote_provider.get_quotes(tickers)
+        self.quote_history.record(quotes)
         return quotes
 
+    @pyro.expose
+    def get_history(self,
+                    ticker: str,
+                    from_date: str,
+                    to_date: str,
+                    resolution: float) -> List[Dict[str, Any]]:
+        """
+        Retorna o histórico de cotações de uma ação em barras OHLC,
+        no formato {'time', 'open', 'high', 'low', 'close'}.
+        Só tem as cotações que o mercado buscou enquanto estava rodando.
+
+        :param ticker: Ação.
+        :param from_date: Começo do intervalo, no formato `DATETIME_FORMAT`.
+        :param to_date: Fim do intervalo, no formato `DATETIME_FORMAT`.
+        :param resolution: Duração de cada barra em segundos.
+        """
+        return self.quote_history.get_bars(
+            ticker,
+            datetime.datetime.strptime(from_date, DATETIME_FORMAT),
+            datetime.datetime.strptime(to_date, DATETIME_FORMAT),
+            resolution)
+
     @pyro.expose
     def get_orders(self,
                    client_names: Sequence[str],
@@ -635,8 +1145,6 @@ class StockMarket:
         :param client_names: Nome dos clientes.
         :param active_only: Se retorna só as ordens ativas, ou todas.
         """
-        self.try_execute_active_orders(OrderType.BUY)
-        self.try_execute_active_orders(OrderType.SELL)
         orders = {}
         for client in client_names:
             orders[client] = self.get_client_orders_by_name(client, active_only)
@@ -659,19 +1167,11 @@ class StockMarket:
         client_name_to_id = self.get_client_ids_by_names(client_names)
         ids = tuple(client_name_to_id.values())
         client_id_to_name = {client_name_to_id[name]: name for name in client_name_to_id}
-        ids_str = str(ids) if len(ids) > 1 else f'({ids[0]})'
 
         # Pega as informações do DB
-        command = (
-            f"""select bo.ticker, so.client_id, bo.client_id, t.amount, t.price, t.datetime, t.id from
-                StockTransaction as t
-                inner join SellOrder as so on t.sell_id = so.id
-                inner join BuyOrder as bo on t.buy_id = bo.id
-                where (bo.client_id in {ids_str} or so.client_id in {ids_str})""" +
-            (f"and datetime(t.datetime) >= datetime('{from_date}')"
-                if from_date is not None else '')
-        )
-        data = self.db.execute_with_fetch(command, True)
+        data = self.db.run_query(
+            queries.SELECT_CLIENT_TRANSACTIONS, client_ids=json.dumps(list(ids)),
+            from_time=text_to_epoch_ms(from_date) if from_date is not None else 0)
 
         # Transforma em um formato mais amigavel, separando por cliente
         transactions = {client: [] for client in client_names}
@@ -683,7 +1183,7 @@ class StockMarket:
                     buyer_name=client_id_to_name[entry[2]] if entry[2] in client_id_to_name else "Market",
                     amount=entry[3],
                     price=entry[4],
-                    datetime=datetime.datetime.strptime(entry[5], DATETIME_FORMAT),
+                    datetime=from_epoch_ms(entry[5]),
                     id_=entry[6]
                 ))
             if entry[2] in ids:
@@ -693,7 +1193,7 @@ class StockMarket:
                     buyer_name=client_id_to_name[entry[2]],
                     amount=entry[3],
                     price=entry[4],
-                    datetime=datetime.datetime.strptime(entry[5], DATETIME_FORMAT),
+                    datetime=from_epoch_ms(entry[5]),
                     id_=entry[6]
                 ))
         return transactions
@@ -701,4 +1201,7 @@ class StockMarket:
     @pyro.expose
     def get_stock_owned_by_client(self, client_name: str) -> Dict[str, float]:
         """Retorna a carteira de ações de um cliente."""
-        return self.db.get_stock_owned_by_client(client_name)
+        client_id = self.clients.get_id(client_name)
+        if client_id is None:
+            return {}
+        return self.db.get_stock_owned_by_client(client_id)
@@ -0,0 +1,79 @@
+"""Cache persistente de quais ações existem."""
+import threading
+import time
+from typing import Callable, Dict, Tuple
+
+from . import queries
+from .database import Database
+
+# Tempo em segundos que uma ação que existe continua válida no cache
+POSITIVE_TTL = 24 * 60 * 60
+# Tempo em segundos que uma ação que não existe continua válida no cache
+NEGATIVE_TTL = 10 * 60
+
+
+class TickerCache:
+    """
+    Guarda se cada ação existe, para não perguntar de novo à fonte de cotações.
+
+    As respostas ficam em um dicionário em memória e na tabela TickerCache do DB,
+    então continuam valendo depois de reiniciar o mercado.
+    Ações que existem e que não existem têm tempos de validade separados,
+    porque uma ação nova pode passar a existir mas uma ação existente raramente some.
+
+    :param db: Banco de dados do mercado.
+    :param check: Função que pergunta à fonte de cotações se uma ação existe.
+    :param positive_ttl: Validade em segundos de uma ação que existe.
+    :param negative_ttl: Validade em segundos de uma ação que não existe.
+    """
+    def __init__(self,
+                 db: Database,
+                 check: Callable[[str], bool],
+                 positive_ttl: float = POSITIVE_TTL,
+                 negative_ttl: float = NEGATIVE_TTL):
+        self.db = db
+        self.check = check
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        # {ticker: (existe, momento da checagem em segundos desde a época)}
+        self.entries: Dict[str, Tuple[bool, float]] = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Carrega o cache do DB.
+        As ações que já aparecem em ordens ou carteiras foram validadas quando foram usadas,
+        então entram no cache como existentes.
+        """
+        now = time.time()
+        data = self.db.run_query(queries.SELECT_TICKER_CACHE)
+        entries = {ticker: (bool(exists), checked_at) for ticker, exists, checked_at in data}
+        seen = self.db.run_query(queries.SELECT_USED_TICKERS)
+        for (ticker,) in seen:
+            if not entries.get(ticker, (False,))[0]:
+                entries[ticker] = (True, now)
+        with self.lock:
+            self.entries.update(entries)
+
+    def exists(self, ticker: str) -> bool:
+        """Retorna se uma ação existe, só perguntando à fonte de cotações se não está no cache."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(ticker)
+        if entry is not None:
+            exists, checked_at = entry
+            ttl = self.positive_ttl if exists else self.negative_ttl
+            if now - checked_at < ttl:
+                return exists
+
+        exists = self.check(ticker)
+        self.store(ticker, exists)
+        return exists
+
+    def store(self, ticker: str, exists: bool):
+        """Guarda no cache se uma ação existe."""
+        checked_at = time.time()
+        with self.lock:
+            self.entries[ticker] = (exists, checked_at)
+        self.db.run_query(queries.REPLACE_TICKER_CACHE,
+                          ticker=ticker, exists=int(exists), checked_at=checked_at)
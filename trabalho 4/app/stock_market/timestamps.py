@@ -0,0 +1,29 @@
+"""
+Conversão das datas guardadas no DB.
+
+As datas de expiração das ordens e as datas das transações ficam no DB como
+inteiros em milissegundos desde a época, para que os filtros por data sejam
+comparações de inteiros que usam índice.
+As datas em memória são `datetime` sem fuso, no horário local, como no resto do mercado.
+"""
+import datetime
+from typing import Optional
+
+from ..consts import DATETIME_FORMAT
+
+
+def to_epoch_ms(date: datetime.datetime) -> int:
+    """Converte uma data para milissegundos desde a época."""
+    return round(date.timestamp() * 1000)
+
+
+def from_epoch_ms(epoch_ms: int) -> datetime.datetime:
+    """Converte milissegundos desde a época para uma data."""
+    return datetime.datetime.fromtimestamp(epoch_ms / 1000)
+
+
+def text_to_epoch_ms(text: Optional[str]) -> Optional[int]:
+    """Converte uma data no formato `DATETIME_FORMAT` para milissegundos desde a época."""
+    if text is None:
+        return None
+    return to_epoch_ms(datetime.datetime.strptime(text, DATETIME_FORMAT))
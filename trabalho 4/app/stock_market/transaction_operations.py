@@ -12,12 +12,14 @@ import Pyro5.api
 import Pyro5.core
 import Pyro5.errors
 
+from . import queries
 from .database import Database
-from ..consts import DATETIME_FORMAT
+from .timestamps import to_epoch_ms
 from ..enums import OrderType, TransactionState, VotingState
 from ..order import Order, Transaction
 
 PARTICIPANT_VOTING_TIMEOUT = 5
+TRANSACTION_COMPLETION_TIMEOUT = 30
 
 class ParticipantTransaction:
     """
@@ -147,6 +149,37 @@ class CoordinatorTransaction:
             finished_participants=dict_['finished_participants']
         )
 
+class TransactionHandle:
+    """
+    Permite esperar o fim de uma transação aberta no coordenador.
+    É resolvido quando os dois participantes terminam a transação ou quando ela é abortada.
+
+    :param id_: Id da transação.
+    """
+    def __init__(self, id_: int):
+        self.id = id_
+        self.state: Optional[TransactionState] = None
+        self._finished = threading.Event()
+
+    def resolve(self, state: TransactionState):
+        """Marca a transação como terminada, acordando quem está esperando."""
+        self.state = state
+        self._finished.set()
+
+    def done(self) -> bool:
+        """Retorna se a transação já terminou."""
+        return self._finished.is_set()
+
+    def wait(self, timeout: Optional[float] = TRANSACTION_COMPLETION_TIMEOUT) -> bool:
+        """
+        Espera a transação terminar.
+        Retorna se terminou ou se acabou o tempo de espera.
+
+        :param timeout: Tempo máximo de espera em segundos. Se None, espera para sempre.
+        """
+        return self._finished.wait(timeout)
+
+
 Pyro5.api.SerializerBase.register_class_to_dict(ParticipantTransaction, ParticipantTransaction.to_dict)
 Pyro5.api.SerializerBase.register_dict_to_class('ParticipantTransaction', ParticipantTransaction.from_dict)
 
@@ -159,6 +192,9 @@ class Coordinator:
 
     def __init__(self, db: Database, daemon: Pyro5.api.Daemon):
         self.transaction_operations: Dict[int, CoordinatorTransaction] = {}
+        # Transações que ainda não terminaram, para avisar quem está esperando
+        self.transaction_handles: Dict[int, TransactionHandle] = {}
+        self.handles_lock = threading.Lock()
         self.participants: Dict[str, Pyro5.core.URI] = {}
         
         sys.excepthook = Pyro5.errors.excepthook
@@ -227,15 +263,15 @@ class Coordinator:
         
         return tid
 
-    @Pyro5.api.expose
     def open_transaction(self,
                          buy_order_id: int,
                          sell_order_id: int,
                          amount: float,
                          price: float,
-                         tid: Optional[int] = None) -> int:
+                         tid: Optional[int] = None) -> TransactionHandle:
         """
         Cria uma operação de transação.
+        Retorna um handle que é resolvido quando a transação termina.
 
         :param buy_order: Id da ordem de compra.
         :param sell_order: Id da ordem de venda.
@@ -270,6 +306,10 @@ class Coordinator:
         
         self.save_temporary_state()
 
+        handle = TransactionHandle(transaction_id)
+        with self.handles_lock:
+            self.transaction_handles[transaction_id] = handle
+
         with Pyro5.api.Proxy(buyer_uri) as buyer_proxy :
             buyer_proxy.prepare_transaction(buy_transaction)
         with Pyro5.api.Proxy(seller_uri) as seller_proxy :
@@ -279,7 +319,30 @@ class Coordinator:
                          args=(transaction_id,),
                          daemon=True).start()
 
-        return transaction_id
+        return handle
+
+    def resolve_transaction(self, transaction_id: int, state: TransactionState):
+        """Avisa quem está esperando uma transação que ela terminou."""
+        with self.handles_lock:
+            handle = self.transaction_handles.pop(transaction_id, None)
+        if handle is not None:
+            handle.resolve(state)
+
+    def forget_transaction_handle(self, transaction_id: int):
+        """Para de avisar o fim de uma transação, quando quem esperava desistiu de esperar."""
+        with self.handles_lock:
+            self.transaction_handles.pop(transaction_id, None)
+
+    def get_transaction_outcome(self, transaction_id: int) -> Optional[TransactionState]:
+        """
+        Retorna COMPLETED se os dois participantes já terminaram a transação,
+        ABORTED se ela foi abortada ou não existe, ou None se ela ainda não terminou.
+        """
+        if self.get_transaction_state(transaction_id) == TransactionState.ABORTED:
+            return TransactionState.ABORTED
+        if self.is_transaction_finished(transaction_id):
+            return TransactionState.COMPLETED
+        return None
 
     def is_transaction_finished(self, transaction_id: int):
         if (transaction_id in self.transaction_operations):
@@ -352,6 +415,7 @@ class Coordinator:
             for participant_name in participants:
                 with Pyro5.api.Proxy(self.participants[participant_name]) as participant_proxy:
                     participant_proxy.cancel_transaction(transaction_id)
+            self.resolve_transaction(transaction_id, TransactionState.ABORTED)
 
     @Pyro5.api.expose
     def signal_transaction_completed(self, transaction_id: int, order_id: int, order_type: str):
@@ -379,6 +443,7 @@ class Coordinator:
                                             transaction.amount,
                                             transaction.price,
                                             transaction_id)
+                self.resolve_transaction(transaction_id, TransactionState.COMPLETED)
         else:
             print("Coordinator.signal_transaction_completed: Invalid transaction id")
 
@@ -397,16 +462,13 @@ class Coordinator:
         :param trade_price: Preço negociado
         """
 
-        command = (
-            f"""insert into StockTransaction (sell_id, buy_id, amount, price, datetime)
-            values (
-                {sell_order_id},
-                {buy_order_id},
-                {transaction_amount},
-                {trade_price},
-                '{datetime.datetime.now().strftime(DATETIME_FORMAT)}'
-            )""")
-        self.db.execute(command)
+        self.db.run_query(
+            queries.INSERT_TRANSACTION,
+            sell_id=sell_order_id,
+            buy_id=buy_order_id,
+            amount=transaction_amount,
+            price=trade_price,
+            datetime=to_epoch_ms(datetime.datetime.now()))
 
         self.save_state(transaction_id)
 
@@ -440,6 +502,7 @@ class Participant:
     Representa um participante de uma transação.
 
     :param name: Nome do participante
+    :param client_id: Id no DB do cliente do participante
     :param coordinator_uri: Endereço pyro do participante
     :param db: Banco de dados a ser usado
     :param daemon: Thread onde o participante será registrado
@@ -447,12 +510,14 @@ class Participant:
 
     def __init__(self,
                  name: str,
+                 client_id: int,
                  coordinator_uri: Pyro5.core.URI,
                  db: Database,
                  daemon: Pyro5.api.Daemon):
         sys.excepthook = Pyro5.errors.excepthook
         
         self.name = name
+        self.client_id = client_id
         self.coordinator_uri = coordinator_uri
         self.uri = daemon.register(self)
         self.db = db
@@ -524,7 +589,7 @@ class Participant:
         else:
             transaction.order.amount -= transaction.amount
 
-        owned_stock = self.db.get_stock_owned_by_client(self.name)
+        owned_stock = self.db.get_stock_owned_by_client(self.client_id)
         if (transaction.order.ticker in owned_stock):
             if (transaction.order.type == OrderType.BUY):
                 transaction.owned_stock_amount = owned_stock[transaction.order.ticker] + transaction.amount
@@ -582,28 +647,23 @@ class Participant:
 
         # Se esgota a ordem, marca como inativa
         if not transaction.order.active:
-            self.db.execute(
-                f'''update {transaction.order.type.value}
-                    set active = 0 
-                    where id = {transaction.order_id}''')
+            self.db.run_query(
+                queries.DEACTIVATE_ORDER[transaction.order.type], id=transaction.order_id)
             new_id = transaction.order_id
         # Se não, atualiza para ter a quantidade que sobrou da ordem
         # E cria a ordem parcial que foi executada
         else:
-            self.db.execute(
-                f'''update {transaction.order.type.value}
-                    set amount = {transaction.order.amount}
-                    where id = {transaction.order_id}''')
-            new_id = self.db.execute(
-                f'''insert into {transaction.order.type.value} (ticker, amount, price, expiry_date, client_id, active)
-                    values (
-                        '{transaction.order.ticker}',
-                        {transaction.amount},
-                        {transaction.order.price},
-                        '{transaction.order.expiry_date}', 
-                        (select id from Client where name = '{transaction.order.client_name}'),
-                        0
-                    )''')
+            self.db.run_query(
+                queries.UPDATE_ORDER_AMOUNT[transaction.order.type],
+                id=transaction.order_id, amount=transaction.order.amount)
+            new_id = self.db.run_query(
+                queries.INSERT_ORDER[transaction.order.type],
+                ticker=transaction.order.ticker,
+                amount=transaction.amount,
+                price=transaction.order.price,
+                expiry_date=to_epoch_ms(transaction.order.expiry_date),
+                client_id=self.client_id,
+                active=0)
         if (transaction.owned_stock_amount is not None):
             self.update_owned_stock(transaction.order.ticker, transaction.owned_stock_amount)
         else:
@@ -628,22 +688,19 @@ class Participant:
         :param current_stock_amount: Quantidade atual de ações da ação ticker.
         """
         # Pega o id da entrada no db, para a quantidade que o cliente tem daquela ação
-        id_owned_stock = self.db.execute_with_fetch(
-            f'''select id from OwnedStock 
-                    where ticker = '{ticker}' and
-                    client_id = (select id from Client where name = '{self.name}')''', False)
+        id_owned_stock = self.db.run_query(
+            queries.SELECT_OWNED_STOCK_ID, ticker=ticker, client_id=self.client_id)
 
         # Se tem a ação, atualiza a quantidade
         if id_owned_stock:
             id_owned_stock = id_owned_stock[0]
-            self.db.execute(
-                f'''update OwnedStock set amount={current_stock_amount}
-                        where id = {id_owned_stock}''')
+            self.db.run_query(
+                queries.UPDATE_OWNED_STOCK_AMOUNT, id=id_owned_stock, amount=current_stock_amount)
         #Se não tem, adiciona a ação
         else:
-            self.db.execute(
-                f'''insert into OwnedStock (ticker, amount, client_id)
-                        values ('{ticker}', {current_stock_amount}, (select id from Client where name = '{self.name}'))''')
+            self.db.run_query(
+                queries.INSERT_OWNED_STOCK,
+                ticker=ticker, amount=current_stock_amount, client_id=self.client_id)
 
     @Pyro5.api.expose
     def cancel_transaction(self, transaction_id: int):
@@ -789,10 +846,8 @@ class MarketParticipant:
             return
         # Cria a ordem no nome do mercado no db
 
-        self.db.execute(
-                f'''update {transaction.order.type.value}
-                    set active = 0 
-                    where id = {transaction.order_id}''')
+        self.db.run_query(
+            queries.DEACTIVATE_ORDER[transaction.order.type], id=transaction.order_id)
 
         transaction.state = TransactionState.COMPLETED
         self.save_state(transaction_id)
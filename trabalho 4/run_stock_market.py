@@ -5,5 +5,7 @@ import time
 from app.enums import OrderType
 from app.order import Order
 from app.stock_market import StockMarket
+from app.stock_market.quote_providers import quote_provider_from_env
 
-the_stock_market = StockMarket('./app/stock_market/stock_market.db', use_pyro=True)
+the_stock_market = StockMarket('./app/stock_market/stock_market.db', use_pyro=True,
+                               quote_provider=quote_provider_from_env())
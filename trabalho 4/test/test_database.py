@@ -0,0 +1,37 @@
+"""
+Testes dos planos das consultas do banco de dados.
+Rodar da pasta do trabalho com `python -m pytest test/test_database.py`.
+"""
+import shutil
+
+import pytest
+
+from app.stock_market import queries
+from app.stock_market.database import Database
+
+BASE_DB = './app/stock_market/stock_market.db'
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = str(tmp_path / 'stock_market.db')
+    shutil.copy(BASE_DB, path)
+    db = Database(path)
+    db.migrate()
+    yield db
+    db.close()
+
+
+def test_query_plans_have_no_regressions(db):
+    assert db.check_query_plans() == []
+
+
+def test_expiry_batch_must_search_by_id(db):
+    # Filtrando por `active` primeiro, o sqlite percorre todas as ordens ativas
+    by_active = queries.Query(
+        'deactivate_by_active',
+        'update BuyOrder set active = 0 where active = 1 and id in (select value from json_each(:ids))',
+        queries.Fetch.NONE)
+    assert db.check_query_plans([], [by_active]) != []
+    for query in queries.DEACTIVATE_ACTIVE_ORDERS.values():
+        assert db.check_query_plans([], [query]) == []
@@ -0,0 +1,34 @@
+"""
+Testes das migrações do banco de dados.
+Rodar da pasta do trabalho com `python -m pytest test/test_migrations.py`.
+"""
+import shutil
+import sqlite3
+
+from app.stock_market.database import Database
+
+# DB na versão 0 do esquema, antes de todas as migrações
+BASE_DB = './app/stock_market/stock_market.db'
+
+
+def test_merge_duplicate_owned_stock_keeps_total(tmp_path):
+    path = str(tmp_path / 'stock_market.db')
+    shutil.copy(BASE_DB, path)
+    connection = sqlite3.connect(path)
+    client_id = connection.execute("insert into Client (name) values ('migration_test')").lastrowid
+    for amount in (100, 50):
+        connection.execute(
+            'insert into OwnedStock (ticker, amount, client_id) values (?, ?, ?)',
+            ('ABEV3.SA', amount, client_id))
+    connection.commit()
+    connection.close()
+
+    db = Database(path)
+    try:
+        db.migrate()
+        rows = db.execute_with_fetch(
+            'select amount from OwnedStock where client_id = ? and ticker = ?',
+            True, (client_id, 'ABEV3.SA'))
+    finally:
+        db.close()
+    assert rows == [(150,)]
@@ -0,0 +1,55 @@
+"""
+Testes da reprodução de sessões gravadas curtas.
+Rodar da pasta do trabalho com `python -m pytest test/test_quote_providers.py`.
+"""
+import json
+
+import pytest
+
+from app.stock_market import quote_providers
+from app.stock_market.quote_providers import ReplayQuoteProvider
+
+
+def write_session(path, records):
+    """Grava uma sessão no formato do RecordingQuoteProvider."""
+    with open(path, 'w') as fp:
+        for time_, quotes in records:
+            fp.write(json.dumps({'time': time_, 'quotes': quotes}) + '\n')
+    return str(path)
+
+
+def replay(path, speed, calls, monkeypatch):
+    """Reproduz uma sessão em loop, com o relógio avançando meio segundo entre os pedidos."""
+    now = [0.0]
+    monkeypatch.setattr(quote_providers.time, 'monotonic', lambda: now[0])
+    provider = ReplayQuoteProvider(path, loop=True, speed=speed)
+    prices = []
+    for _ in range(calls):
+        prices.append(provider.get_quotes(['ABEV3.SA'])['ABEV3.SA'])
+        now[0] += 0.5
+    return prices
+
+
+@pytest.mark.parametrize('speed', [None, 1.0])
+def test_one_record_session(tmp_path, monkeypatch, speed):
+    path = write_session(tmp_path / 'session.jsonl', [(100.0, {'ABEV3.SA': 13.5})])
+    assert replay(path, speed, 6, monkeypatch) == [13.5] * 6
+
+
+@pytest.mark.parametrize('speed', [None, 1.0])
+def test_same_timestamp_session(tmp_path, monkeypatch, speed):
+    path = write_session(
+        tmp_path / 'session.jsonl',
+        [(100.0, {'ABEV3.SA': 13.5}), (100.0, {'ABEV3.SA': 13.6})])
+    prices = replay(path, speed, 6, monkeypatch)
+    if speed is None:
+        assert prices == [13.5, 13.6] * 3
+    else:
+        assert prices == [13.6] * 6
+
+
+def test_asap_loop_serves_last_record(tmp_path, monkeypatch):
+    path = write_session(
+        tmp_path / 'session.jsonl',
+        [(0.0, {'ABEV3.SA': 1.0}), (1.0, {'ABEV3.SA': 2.0}), (2.0, {'ABEV3.SA': 3.0})])
+    assert replay(path, None, 7, monkeypatch) == [1.0, 2.0, 3.0, 1.0, 2.0, 3.0, 1.0]
@@ -1,11 +1,19 @@
 import datetime
+import os
 import time
 
 from app.enums import OrderType
 from app.order import Order
 from app.stock_market import StockMarket
+from app.stock_market.quote_providers import quote_provider_from_env
 
-the_stock_market = StockMarket('./app/stock_market/stock_market.db', use_pyro=False)
+# Por padrão roda com as cotações gravadas, sem acessar a rede
+os.environ.setdefault('STOCK_MARKET_QUOTES', 'replay')
+os.environ.setdefault('STOCK_MARKET_REPLAY_FILE', os.path.join(os.path.dirname(__file__), 'replay_session.jsonl'))
+os.environ.setdefault('STOCK_MARKET_REPLAY_LOOP', '1')
+
+the_stock_market = StockMarket('./app/stock_market/stock_market.db', use_pyro=False,
+                               quote_provider=quote_provider_from_env())
 
 print("\n\nteste adicionar cliente")
 the_stock_market.add_client("Teste")
@@ -77,7 +85,7 @@ order.client_name = "Teste2"
 the_stock_market.create_order(order)
 
 print("\n\nTestando verificar se o restante da venda vai ser executado pelo banco")
-the_stock_market.try_execute_active_orders()
+the_stock_market.trigger_sweep()
 
 print("\n\nTestando criar uma ordem de compra com cliente interno para ser terminada com o mercado")
 order.type = OrderType.BUY